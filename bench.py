@@ -0,0 +1,249 @@
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from multiprocessing import cpu_count
+
+"""Бенчмарки индексации и расстановки ссылок на синтетической коллекции.
+
+generate_corpus создает каталог data/ той же структуры, что и настоящая коллекция: папка на документ,
+в ней Properties.xml с названием и html-документ. Среди документов есть основные (договоры, положения),
+"Изменения и дополнения" к ним с абзацами «...» после "в следующей редакции:" и короткими заменами
+("Заменить в подпункте ... словосочетание «...» на словосочетание «...»"), и приказы, которые упоминают
+названия основных документов.
+
+Пример запуска:
+python bench.py -s 100 1000 -o bench_new.json --compare bench_old.json
+"""
+
+DEFAULT_SIZES = (100, 1000, 10000)
+
+# the words of the titles: the title of the main document is cut out of the clean title of the amendment
+# by re.split(' к|во? ') (see Document), so no stem of them starts with "к" or ends with "в" or "во"
+# ("контроля", "средств", "общества", "правил", "условий" and "пластиковых" would cut it short)
+TITLE_WORDS = (u"договор банковского счета юридических лиц индивидуальных предпринимателей открытого акционерного "
+               u"банк втб порядке обслуживания расчетных операций физических депозитных сберегательных "
+               u"гарантийных эмиссии ценных бумаг тарифов операционного дня региона филиалов "
+               u"дистанционного электронного документооборота валютного наличных денежных "
+               u"рублях иностранной валюте зарплатных проектов").split()
+TEXT_WORDS = (u"банк обязуется открыть счет клиента указанный заявлении течение двух рабочих дней клиент соблюдать "
+              u"требования законодательства правила проведения операций предоставлять документы необходимые "
+              u"для совершения операции списание денежных средств осуществляется на основании распоряжения "
+              u"стороны несут ответственность неисполнение обязательств договору порядке установленном "
+              u"настоящим договором тарифами банка уведомление направляется письменной форме").split()
+MONTHS = (u"января", u"февраля", u"марта", u"апреля", u"мая", u"июня", u"июля", u"августа", u"сентября",
+          u"октября", u"ноября", u"декабря")
+KINDS = ("main", "main", "main", "main", "main", "main", "amendment", "amendment", "amendment", "order")
+
+PROPERTIES = u"""<?xml version="1.0" encoding="utf-8"?>
+<Properties>
+<Subject>{title}</Subject>
+</Properties>
+"""
+HTML = u"""<html>
+<head>
+<meta http-equiv="Content-Type" content="text/html; charset={charset}">
+<title>{title}</title>
+</head>
+<body>
+{body}
+</body>
+</html>
+"""
+
+
+def folder_name(seed, i):
+    return hashlib.md5("{}-{}".format(seed, i).encode("ascii")).hexdigest().upper()
+
+
+def sentence(rnd, words=12):
+    return " ".join(rnd.choice(TEXT_WORDS) for _ in range(words)).capitalize()
+
+
+def write_doc(root, folder, fname, title, paragraphs, encoding):
+    path = os.path.join(root, "data", folder)
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, "Properties.xml"), "w", encoding="utf-8") as fh:
+        fh.write(PROPERTIES.format(title=title))
+    charset = "windows-1251" if encoding == "cp1251" else "utf-8"
+    html = HTML.format(charset=charset, title=title, body="\n".join(paragraphs))
+    with open(os.path.join(path, fname), "w", encoding=encoding) as fh:
+        fh.write(html)
+
+
+def main_doc(rnd):
+    """(the title, the numbered paragraphs as (number, text))"""
+    title = " ".join([u"Договор"] + rnd.sample(TITLE_WORDS, 14))
+    clauses = []
+    for section in range(1, rnd.randint(3, 6)):
+        for clause in range(1, rnd.randint(3, 5)):
+            for item in range(1, rnd.randint(2, 5)):
+                clauses.append(("{}.{}.{}.".format(section, clause, item), sentence(rnd, rnd.randint(10, 25))))
+    return title, clauses
+
+
+def generate_corpus(root, size, seed=0):
+    """Create root/data with size documents; returns the number of documents of each kind
+       and the folder of the main document of each amendment by its folder"""
+    rnd = random.Random(seed)
+    shutil.rmtree(os.path.join(root, "data"), ignore_errors=True)
+    mains = []
+    main_of = {}
+    counts = dict.fromkeys(set(KINDS), 0)
+    for i in range(size):
+        kind = KINDS[i % len(KINDS)] if mains else "main"
+        counts[kind] += 1
+        folder = folder_name(seed, i)
+        encoding = rnd.choice(("utf-8", "cp1251"))
+        if kind == "main":
+            title, clauses = main_doc(rnd)
+            mains.append((title, clauses, folder))
+            paragraphs = [u'<p><a name="p{n}"></a>{num} {text}</p>'.format(n=n, num=num, text=text)
+                          for n, (num, text) in enumerate(clauses)]
+            write_doc(root, folder, u"{}_2017Н.html".format(i), title, paragraphs, encoding)
+        elif kind == "amendment":
+            main_title, clauses, main_folder = rnd.choice(mains)
+            main_of[folder] = main_folder
+            title = u"Изменения и дополнения к " + main_title
+            paragraphs = [u"<p>Внести следующие изменения:</p>"]
+            for n, (num, text) in enumerate(rnd.sample(clauses, min(len(clauses), rnd.randint(1, 6))), 1):
+                paragraphs.append(u'<p><a name="z{n}"></a>{n}. Пункт {num} изложить в следующей редакции:</p>'.format(
+                    n=n, num=num.rstrip(".")))
+                paragraphs.append(u"<p>«{num} {text}».</p>".format(num=num, text=text))
+            for n, (num, text) in enumerate(rnd.sample(clauses, min(len(clauses), rnd.randint(0, 3))), n + 1):
+                words = text.split()
+                k = rnd.randint(0, len(words) - 2)
+                scope = u"в подпункте {} Договора".format(num.rstrip(".")) if rnd.random() < 0.5 else u"в тексте Договора"
+                wording = rnd.choice((u"Заменить {scope} словосочетание «…{old}…» на словосочетание «…{new}…».",
+                                      u"{Scope} слова «{old}» заменить словами «{new}»."))
+                paragraphs.append(u'<p><a name="z{n}"></a>{n}. '.format(n=n) + wording.format(
+                    scope=scope, Scope=scope[0].upper() + scope[1:], old=" ".join(words[k:k + 2]),
+                    new=sentence(rnd, 2).lower()) + u"</p>")
+            write_doc(root, folder, u"{}_2017Н4.html".format(i), title, paragraphs, encoding)
+        else:
+            day, month, year, number = rnd.randint(1, 28), rnd.choice(MONTHS), rnd.randint(2002, 2018), i
+            title = u"Приказ Банка от {} {} {} № {}".format(day, month, year, number)
+            mentioned = rnd.choice(mains)[0]
+            paragraphs = [u"<p>от {} {} {} г. № {}</p>".format(day, month, year, number),
+                          u"<p>Утвердить {} и ввести его в действие.</p>".format(mentioned),
+                          u"<p>{}.</p>".format(sentence(rnd))]
+            write_doc(root, folder, u"{}_{}.html".format(i, year), title, paragraphs, encoding)
+    return counts, main_of
+
+
+@contextlib.contextmanager
+def quiet():
+    """the modules print the names of the written files and the timings, we don't need them here"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def measure(results, size, name, func, calls=1):
+    with quiet():
+        begin = time.perf_counter()
+        result = func()
+        seconds = time.perf_counter() - begin
+    results.append({"size": size, "benchmark": name, "seconds": round(seconds, 6), "calls": calls,
+                    "per_call": round(seconds / calls, 9) if calls else None})
+    print ("{:>6} {:<28} {:10.3f} s  ({} calls)".format(size, name, seconds, calls), file=sys.stderr)
+    return result
+
+
+def bench_size(size, processes, seed, workdir):
+    from indexer import Indexer
+    from linker import find_sources, gen_matches, process_target_html, modify_source_html, MARKER_TEXT
+    from replacements import ShortReplacements
+    from head_linker import add_head_links
+
+    results = []
+    root = os.path.join(workdir, str(size))
+    os.makedirs(root, exist_ok=True)
+    _, main_of = generate_corpus(root, size, seed)
+    cwd = os.getcwd()
+    os.chdir(root)
+    try:
+        s = Indexer(size)
+        measure(results, size, "Indexer.run", lambda: s.run(processes=processes), size)
+        measure(results, size, "Indexer.pickle", s.pickle, size)
+        # nothing has changed, so only the metadata is loaded and the fingerprints are checked
+        s = Indexer(size)
+        measure(results, size, "Indexer.run incremental", lambda: s.run(incremental=True, processes=processes), size)
+        index, title_index = s.index, s.title_index
+        amendments = [doc for doc in index.values() if doc.is_amendment]
+        sources = measure(results, size, "find_sources",
+                          lambda: [find_sources(index, doc, title_index) for doc in amendments], len(amendments))
+        # otherwise the benchmarks of the linking time empty work
+        lost = [doc.folder for doc, doc_sources in zip(amendments, sources)
+                if main_of[doc.folder] not in {source.folder for source in doc_sources}]
+        assert not lost, "{} of {} amendments do not find their main documents".format(len(lost), len(amendments))
+        hypotheses = measure(results, size, "gen_matches",
+                             lambda: [(pattern, source, doc) for doc, doc_sources in zip(amendments, sources)
+                                      for pattern, source in gen_matches(index, doc, MARKER_TEXT, sources=doc_sources)],
+                             len(amendments))
+        paragraphs = measure(results, size, "process_target_html",
+                             lambda: [process_target_html(pattern, target, MARKER_TEXT)
+                                      for pattern, _, target in hypotheses], len(hypotheses))
+        measure(results, size, "modify_source_html",
+                lambda: [modify_source_html(pattern, source, target, paragraph)
+                         for (pattern, source, target), paragraph in zip(hypotheses, paragraphs)], len(hypotheses))
+        tasks = [((doc.html_file, doc.folder), [(source.html_file, source.folder) for source in doc_sources])
+                 for doc, doc_sources in zip(amendments, sources) if doc_sources]
+        replacements = measure(results, size, "ShortReplacements", lambda: ShortReplacements(index, tasks), len(tasks))
+        measure(results, size, "ShortReplacements.source_edits",
+                lambda: [replacements.source_edits(index[key], key) for key in replacements.sources],
+                len(replacements.sources))
+        measure(results, size, "add_head_links", lambda: add_head_links(index, processes=processes), len(index))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(root, ignore_errors=True)
+    return results
+
+
+def compare(results, old_path):
+    """the ratio new/old for every benchmark found in both runs"""
+    with open(old_path) as fh:
+        old = {(r["size"], r["benchmark"]): r["seconds"] for r in json.load(fh)["results"]}
+    for r in results:
+        before = old.get((r["size"], r["benchmark"]))
+        if before:
+            print ("{:>6} {:<28} {:10.3f} -> {:10.3f} s  x{:.2f}".format(
+                r["size"], r["benchmark"], before, r["seconds"], r["seconds"] / before), file=sys.stderr)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--sizes", help="sizes of the synthetic collections", nargs="+", type=int, default=DEFAULT_SIZES)
+    parser.add_argument("-j", "--jobs", help="number of processes (all the cpus by default)", default=None, type=int)
+    parser.add_argument("--seed", help="seed of the corpus generator", default=0, type=int)
+    parser.add_argument("-o", "--output", help="file for the results in json (stdout by default)")
+    parser.add_argument("--compare", help="results of a previous run to compare with")
+    parser.add_argument("--workdir", help="where to generate the collections (a temporary directory by default)")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    workdir = args.workdir or tempfile.mkdtemp(prefix="links_bench_")
+    jobs = args.jobs or cpu_count()
+    results = []
+    for size in args.sizes:
+        results.extend(bench_size(size, jobs, args.seed, workdir))
+    report = {"python": platform.python_version(), "platform": platform.platform(), "seed": args.seed,
+              "jobs": jobs, "results": results}
+    if args.compare:
+        compare(results, args.compare)
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(report, fh, indent=2)
+    else:
+        print (json.dumps(report, indent=2))
+    if not args.workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,53 @@
+import datetime as dt
+import re
+
+"""Даты в шапках приказов: "от 12 марта 2017 г.", "«12» марта 2017", "12.03.2017".
+Разбираем их заранее скомпилированными регулярками и таблицей месяцев; dateparser (он медленный и долго
+импортируется) вызывается, только если ничего не нашлось.
+"""
+
+# the forms of the names of the months: a stem alone would take "малых" for May
+MONTHS = {u"января": 1, u"январь": 1, u"февраля": 2, u"февраль": 2, u"марта": 3, u"март": 3, u"апреля": 4,
+          u"апрель": 4, u"мая": 5, u"май": 5, u"июня": 6, u"июнь": 6, u"июля": 7, u"июль": 7, u"августа": 8,
+          u"август": 8, u"сентября": 9, u"сентябрь": 9, u"октября": 10, u"октябрь": 10, u"ноября": 11,
+          u"ноябрь": 11, u"декабря": 12, u"декабрь": 12}
+
+WORD_DATE = re.compile(u"«?(\\d{{1,2}})»?\\s+({})(?![а-яё])\\s+(\\d{{4}})".format(
+    "|".join(sorted(MONTHS, key=len, reverse=True))), re.IGNORECASE)
+NUMERIC_DATE = re.compile(r"(?<![\d.])(\d{1,2})\.(\d{1,2})\.(\d{4}|\d{2})(?![\d])")
+
+
+def make_date(year, month, day):
+    if year < 100:
+        year += 2000 if year < 50 else 1900
+    try:
+        return dt.date(year, month, day)
+    except ValueError:
+        return None
+
+
+def find_date(text):
+    """the last date in the text (the one nearest to the number of the order), or None"""
+    found = []
+    for match in WORD_DATE.finditer(text):
+        date = make_date(int(match[3]), MONTHS[match[2].lower()], int(match[1]))
+        if date:
+            found.append((match.start(), date))
+    for match in NUMERIC_DATE.finditer(text):
+        date = make_date(int(match[3]), int(match[2]), int(match[1]))
+        if date:
+            found.append((match.start(), date))
+    if found:
+        return max(found, key=lambda x: x[0])[1]
+    return None
+
+
+def parse_date(text, fallback=True):
+    """the date as an iso string; dateparser is the fallback for the formats we don't know"""
+    date = find_date(text)
+    if date is None and fallback:
+        import dateparser
+        parsed_date = dateparser.parse(text.strip())
+        if parsed_date is not None:
+            date = parsed_date.date()
+    return date.isoformat() if date else None
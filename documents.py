@@ -1,12 +1,37 @@
 import codecs
+import hashlib
 import os
+import pickle
 import re
-import dateparser
-from bs4 import BeautifulSoup, element
+import sys
 import xml.etree.ElementTree as ET
-from utils import clean_text
+from utils import clean_text, normalize, letters_only, deep_sizeof
+from paragraphs import extract, paragraph_text, ParagraphTable
+from dates import parse_date
 
 FOLDER = "data"
+# the bytes which do not decode become lone surrogates and are encoded back as the same bytes,
+# so a file with a broken byte is read, spliced and written without losing or breaking anything
+DECODE_ERRORS = "surrogateescape"
+CHARSET = re.compile(rb"""<meta[^>]+charset\s*=\s*["']?([\w-]+)""", re.IGNORECASE)
+
+
+def decode_html(raw):
+    """(the text, its encoding). The files are either in utf-8 or in cp1251; a valid utf-8 is tried first,
+       because a cp1251 text is almost never valid utf-8, while anything decodes as cp1251"""
+    if raw.startswith(codecs.BOM_UTF8):
+        return raw.decode("utf-8-sig"), "utf-8-sig"
+    candidates = ["utf-8"]
+    match = CHARSET.search(raw[:4096])
+    if match:
+        candidates.append(match[1].decode("ascii").lower())
+    candidates.append("cp1251")
+    for encoding in candidates:
+        try:
+            return raw.decode(encoding), encoding
+        except (LookupError, UnicodeDecodeError):
+            continue
+    return raw.decode("cp1251", errors=DECODE_ERRORS), "cp1251"
 
 class Docs():
     def __init__(self, limit=140):
@@ -32,19 +57,62 @@ class Docs():
 
 
 
+def fingerprint(a_tuple, digest=False):
+    """(mtime, size) of the html-file and of Properties.xml, optionally with the md5 of their content.
+       mtime and size are enough to notice that nothing has changed; the digest lets us tell a real change
+       from a file that was merely rewritten by the nightly refresh"""
+    html_file, folder = a_tuple
+    result = []
+    for fname in (html_file, "Properties.xml"):
+        fullname = os.path.join(FOLDER, folder, fname)
+        st = os.stat(fullname)
+        content_hash = None
+        if digest:
+            with open(fullname, "rb") as fh:
+                content_hash = hashlib.md5(fh.read()).hexdigest()
+        result.append((st.st_mtime_ns, st.st_size, content_hash))
+    return tuple(result)
+
+
+def same_content(old, new):
+    """compare fingerprints made by the function above, content hashes win over mtime"""
+    if old is None or new is None:
+        return False
+    for (old_mtime, old_size, old_hash), (new_mtime, new_size, new_hash) in zip(old, new):
+        if old_hash and new_hash:
+            if old_hash != new_hash:
+                return False
+        elif (old_mtime, old_size) != (new_mtime, new_size):
+            return False
+    return True
+
+
 class Document():
+    """A compact record: the soup and the tree of Properties.xml are dropped as soon as the fields are
+       extracted from them, clean_text and letters are derived from the text on demand"""
+    __slots__ = ("html_file", "folder", "title", "clean_title", "order_titles", "is_amendment", "is_order",
+                 "main_doc_title", "encoding", "text", "paragraphs", "_letters", "_shard")
+    # the fields stored in the shard of the document and loaded on demand, see storage.py
+    HEAVY_FIELDS = ("text", "paragraphs")
+    # derived fields, they are neither pickled nor stored
+    CACHED_FIELDS = ("_letters",)
+    # the version of the stored heavy fields: the shards written with another one can not be read
+    FORMAT = 2
+
     def __init__(self, a_tuple):
         html_file, folder = a_tuple
         self.html_file = html_file
         self.folder = folder
-        self.soup = None
-        self.__tree = None
         self.title = None
         self.clean_title = None
         self.order_titles = []
-        self.get_soup()
+        self._letters = None
+        self._shard = None
+        self.encoding = None
+        html = self.detect_html()
+        # the linker works with the table of paragraphs and does not need to parse the html again
+        self.get_text(html)
         self.get_title()
-        self.get_text()
         self.is_amendment = self.clean_title.startswith(u"изменен и дополнен")
         self.is_order = self.clean_title.startswith(u'приказ')
         if self.is_amendment:
@@ -57,15 +125,80 @@ class Document():
             self.main_doc_title = None
         if self.is_order:
             self.get_order_titles()
-        self.incoming_links = []
-        # self.links = list(self.all_links())
-        self.soup = None # the soup object is not trivially pickled because of the recursion, so we'd better null it
 
        
     def __repr__(self):
         return "<Document: path: {path}; folder {f}; html_file: {html}; title: {t}; processed title: {ct}>".format(f=self.folder, t=self.title, ct=self.clean_title, html=self.html_file, path=os.path.join(self.folder, self.html_file))
 
 
+    def __getstate__(self):
+        state = {}
+        for name in self.__slots__:
+            if name not in self.CACHED_FIELDS and self.is_loaded(name):
+                state[name] = getattr(self, name)
+        return state
+
+    def __setstate__(self, state):
+        # the states pickled by the previous versions have more fields (soup, clean_text, the xml tree...)
+        self._letters = None
+        self._shard = None
+        # the documents of the previous versions were read with the default encoding, see read_html
+        self.encoding = None
+        for name, value in state.items():
+            if name in self.__slots__ and name not in self.CACHED_FIELDS:
+                setattr(self, name, value)
+
+    def __getattr__(self, name):
+        """the large fields of a document loaded from the sharded index are read on the first access"""
+        if name in self.HEAVY_FIELDS and self._shard:
+            with open(self._shard, "rb") as fh:
+                fields = pickle.load(fh)
+            for field in self.HEAVY_FIELDS:
+                setattr(self, field, fields[field])
+            return fields[name]
+        raise AttributeError(name)
+
+    def heavy_fields(self):
+        return {name: getattr(self, name) for name in self.HEAVY_FIELDS}
+
+    def light_state(self):
+        state = self.__getstate__()
+        for name in self.HEAVY_FIELDS + ('_shard',):
+            state.pop(name, None)
+        return state
+
+    def unload(self, shard, drop=True):
+        """from now on the large fields live in the shard"""
+        self._shard = shard
+        if drop:
+            for name in self.HEAVY_FIELDS:
+                if self.is_loaded(name):
+                    delattr(self, name)
+            self._letters = None
+
+    @property
+    def clean_text(self):
+        return clean_text(self.text)
+
+    @property
+    def letters(self):
+        """the text with everything but letters removed, computed once per document"""
+        if self._letters is None:
+            self._letters = letters_only(normalize(self.text))
+        return self._letters
+
+    def field_sizes(self):
+        """field -> its size in bytes, for the fields held in memory now"""
+        return {name: deep_sizeof(object.__getattribute__(self, name)) for name in self.__slots__
+                if self.is_loaded(name)}
+
+    def is_loaded(self, name):
+        try:
+            object.__getattribute__(self, name)
+        except AttributeError:
+            return False
+        return True
+
     def get_order_titles(self):
         self.order_titles = []
         num, date = self.extract_params()
@@ -82,35 +215,78 @@ class Document():
         if len(spl)==2:
             order_num = spl[1]
         if order_num:
-            for elem in self.soup.find_all('p'):
-                if order_num in elem.text:
-                    date= re.split(order_num, elem.text)[0]
-                    parsed_date = dateparser.parse(date.strip())
-                    if parsed_date is not None:
-                        formatted_date = parsed_date.date().isoformat()
+            # the first paragraph with the number and a date before it is the header of the order;
+            # a short number is in most of the paragraphs, so the slow dateparser is tried on the first one only
+            fallback = True
+            for elem, text in self.paragraph_texts():
+                if order_num in text:
+                    date = text.split(order_num)[0]
+                    formatted_date = parse_date(date, fallback=fallback)
+                    fallback = False
+                    if formatted_date is not None:
+                        break
         return (order_num, formatted_date)
 
-    def get_soup(self):
-        if not self.soup:
-            fullname = os.path.join(FOLDER, self.folder, self.html_file)
-            doc = codecs.open(fullname).read()
-            self.soup = BeautifulSoup(doc, "html.parser")
+    def read_html(self):
+        """The html as text; the offsets in the paragraph table are the positions in this text.
+           The encoding is detected on the first reading and then reused, the newlines are kept as they are"""
+        fullname = os.path.join(FOLDER, self.folder, self.html_file)
+        if self.encoding:
+            with open(fullname, encoding=self.encoding, errors=DECODE_ERRORS, newline="") as fh:
+                return fh.read()
+        # a document indexed by a previous version: its offsets were computed for this reading
+        return codecs.open(fullname).read()
+
+    def detect_html(self):
+        fullname = os.path.join(FOLDER, self.folder, self.html_file)
+        with open(fullname, "rb") as fh:
+            html, self.encoding = decode_html(fh.read())
+        return html
+
+    def get_soup(self, html=None):
+        from bs4 import BeautifulSoup
+        return BeautifulSoup(html or self.read_html(), "html.parser")
 
     @property
     def properties_tree(self):
-        if not self.__tree:
-            fname = os.path.join(FOLDER, self.folder, "Properties.xml")
-            tree = ET.parse(fname)
-            self.__tree = tree
-        return self.__tree
+        """parsed every time: we need only the title from it"""
+        fname = os.path.join(FOLDER, self.folder, "Properties.xml")
+        return ET.parse(fname)
 
     def get_title(self):
         root = self.properties_tree.getroot()
         self.title = root.find('Subject').text
         self.clean_title = clean_text(self.title)
     
-    def get_text(self):
-        self.text = self.soup.text
-        self.clean_text = clean_text(self.text)
+    def get_text(self, html):
+        """One pass of html.parser events gives the text and the paragraph table (paragraphs.extract).
+           If it fails, the text is taken from the BeautifulSoup tree, as it used to be; the tree has
+           no positions in the html, so such a document gets no paragraphs and no links are put into it"""
+        try:
+            self.text, self.paragraphs = extract(html)
+        except Exception as error:
+            print ("{}: {!r}, the text is taken from BeautifulSoup".format(
+                os.path.join(self.folder, self.html_file), error), file=sys.stderr)
+            self.text, self.paragraphs = self.get_soup(html).text, ParagraphTable()
+
+    def paragraph_texts(self):
+        """(paragraph, its text) for all the paragraphs"""
+        text = self.text
+        return ((paragraph, paragraph_text(text, paragraph)) for paragraph in self.paragraphs)
 
 
+def memory_report(index):
+    """the memory taken by the documents of the index: (number, total, mean, the largest document and its size,
+       the total size of each of the heavy fields)"""
+    sizes = []
+    fields = dict.fromkeys(Document.HEAVY_FIELDS, 0)
+    for key, doc in index.items():
+        field_sizes = doc.field_sizes()
+        sizes.append((sys.getsizeof(doc) + sum(field_sizes.values()), key))
+        for name in fields:
+            fields[name] += field_sizes.get(name, 0)
+    if not sizes:
+        return (0, 0, 0, None, 0, fields)
+    total = sum(size for size, _ in sizes)
+    largest, key = max(sizes)
+    return (len(sizes), total, total // len(sizes), key, largest, fields)
@@ -1,56 +1,86 @@
 import os
-import re
-from utils import timeit, clean_text
-from documents import FOLDER 
+from multiprocessing import Pool
+from utils import timeit, adaptive_chunksize, warm_up
+from splice import Edit, write_new_html, can_wrap
+from paragraphs import html_offset
+from multimatch import PhraseMatcher
+from metrics import metrics, init_metrics_worker
 
 """Текущие проблемы:
 1) Находит документ "Дополнительное соглашение к Договору банковского счета" по тексту "Заключает договоры и дополнительные соглашения к договорам банковских счетов клиентов дополнительных офисов московского региона".Требовать единственное число? То есть все-таки честно разбирать морфологию?
-2) Так как ищем стемированные слова, ссылки тоже разрезают слово: счет</a>ов
-3) Возможно, нужно запретить искать слишком короткие названия.
-4) Текущая функция add_links_to_doc вставляет по сути только одну ссылку. Чтобы этого избежать, нужно сделать html_text атрибутом документа и каждый раз модифицировать его.
-5) Чтобы уметь эффективно вставлять одну ссылку, нужно отрефакторить add_head_links - словарь заголовков создавать один раз, и уметь вызывать отдельно обработку одного документа
+2) (решено: сравниваем основы целых слов, ссылка охватывает слова целиком) Так как ищем стемированные слова, ссылки тоже разрезают слово: счет</a>ов
+3) (решено: названия короче MIN_TITLE_TOKENS слов не ищем) Возможно, нужно запретить искать слишком короткие названия.
+4) (решено: add_links_to_doc возвращает правки, которые применяются к html один раз, см. splice.py) Текущая функция add_links_to_doc вставляет по сути только одну ссылку.
+5) (решено: автомат названий строится один раз, add_links_to_doc обрабатывает один документ) Чтобы уметь эффективно вставлять одну ссылку, нужно отрефакторить add_head_links - словарь заголовков создавать один раз, и уметь вызывать отдельно обработку одного документа
+
+Названия ищутся не одной огромной регуляркой, а автоматом Ахо-Корасик над основами слов (multimatch.py): текст каждого абзаца просматривается один раз, и находятся самые длинные непересекающиеся вхождения названий.
 """
 
-def str_to_pattern_text(s):
-    return "(\w*[\s\n\W]*)".join([re.escape(elem) for elem in s.split()])
+MIN_TITLE_TOKENS = 3
 
 @timeit
 def collect_titles(index):
     return {doc.clean_title : doc for doc in index.values() if doc.clean_title}
 
 @timeit
-def compile_title_pattern(list_of_pattern_texts):
-    total_pattern_text = "|".join(map(str_to_pattern_text, list_of_pattern_texts))
-    return re.compile(total_pattern_text, re.MULTILINE | re.DOTALL | re.IGNORECASE)
+def compile_title_matcher(title_to_doc, min_tokens=MIN_TITLE_TOKENS):
+    # the values are the keys of the documents, not the documents, so that the matcher is cheap to send to a worker
+    return PhraseMatcher(((doc.title, (doc.html_file, doc.folder)) for doc in title_to_doc.values()),
+                         min_tokens=min_tokens)
 
 @timeit
-def add_head_links(index):
+def add_head_links(index, processes=1):
     title_to_doc = collect_titles(index)
-    total_pattern = compile_title_pattern(title_to_doc.keys())
-    for doc in index.values():
-        add_links_to_doc(doc, total_pattern, title_to_doc)
+    matcher = compile_title_matcher(title_to_doc)
+    keys = list(index)
+    if processes > 1:
+        warm_up(tokenizer=False)
+        pool = Pool(processes=processes, initializer=init_head_worker, initargs=(index, matcher, metrics.enabled))
+        results = pool.imap(head_link_task, keys, chunksize=adaptive_chunksize(len(keys), processes))
+    else:
+        init_head_worker(index, matcher)
+        results = map(head_link_task, keys)
+    for key, (edits, records) in zip(keys, results):
+        metrics.merge(records)
+        if edits:
+            write_new_html(index[key], edits)
+    if processes > 1:
+        pool.close()
+        pool.join()
 
-@timeit
-def add_links_to_doc(doc, pattern, title_to_doc):
-    for match in re.finditer(pattern, doc.text):
-        clean_title = clean_text(match[0])
-        target_doc = title_to_doc.get(clean_title)
-        #there are cases where target_doc is None, and it is worth investigating
-        if target_doc and target_doc != doc:
-             target_fname = os.path.join(target_doc.folder, target_doc.html_file)
-             link_url = "../{}".format(target_fname)
-             pattern = str_to_pattern_text(match[0])
-             doc.get_soup()
-             html_text = str(doc.soup)
-             m = re.search(pattern, html_text)
-             if m:
-                found_text = html_text[m.start(): m.end()]
-                replacement = "<a href={link}>{txt}</a>".format(link=link_url, txt=found_text) 
-                html_text = html_text.replace(found_text, replacement)
-                current_fname = os.path.join(FOLDER, doc.folder, doc.html_file)
-                new_fname = current_fname.replace(".html", "_new.html")
-                with open(new_fname, 'w') as fh:
-                    fh.write(html_text)
-                    print (new_fname)
+# the index and the title matcher of the process, see init_head_worker
+head_index = {}
+head_matcher = None
+
+def init_head_worker(index, matcher, measure=None):
+    global head_index, head_matcher
+    head_index = index
+    head_matcher = matcher
+    if measure is not None:
+        # in a worker process, not in the main one
+        init_metrics_worker(measure)
+        warm_up(tokenizer=False)
 
+def head_link_task(key):
+    """(the edits of the document, metrics of the worker)"""
+    with metrics.document("head links", key):
+        edits = add_links_to_doc(head_index[key], head_matcher)
+    return edits, metrics.drain()
 
+def add_links_to_doc(doc, matcher):
+    """The links found in the paragraphs of the document, as edits of its html (see splice.py);
+       all of them are applied at once, so that a new link does not overwrite the previous ones"""
+    edits = []
+    html_text = None
+    for paragraph, text in doc.paragraph_texts():
+        for start, end, target_key in matcher.find(text):
+            metrics.count("title matches")
+            if target_key == (doc.html_file, doc.folder):
+                continue
+            if html_text is None:
+                html_text = doc.read_html()
+            html_start, html_end = html_offset(paragraph, start), html_offset(paragraph, end)
+            if can_wrap(html_text, paragraph, html_start, html_end):
+                target_fname = os.path.join(target_key[1], target_key[0])
+                edits.append(Edit(html_start, html_end, "../{}".format(target_fname), False))
+    return edits
@@ -1,36 +1,208 @@
+import os
 import pickle
 from multiprocessing import Pool, cpu_count
-from utils import timeit
-from documents import Docs, Document
+from utils import timeit, stem_cache, init_stem_worker, adaptive_chunksize, warm_up
+from metrics import metrics
+from documents import Docs, Document, FOLDER, fingerprint, same_content, memory_report
+from title_index import TitleIndex
+from storage import ShardedStore
+
+PROGRESS_EVERY = 100
+
+
+def parse_doc(a_tuple):
+    """The pool worker. It gets nothing but the (html_file, folder) tuple, so the index is never sent
+       to the worker processes; the fingerprint is taken before parsing, so that a file rewritten
+       in the meantime is parsed again next time.
+       The stems computed by the worker go back with the document, to be saved in the parent's cache,
+       and so do its metrics"""
+    with metrics.document("parse", a_tuple):
+        new_fingerprint = fingerprint(a_tuple, digest=True)
+        doc = Document(a_tuple)
+    metrics.count("documents parsed")
+    return a_tuple, new_fingerprint, doc, stem_cache.drain(), metrics.drain()
+
 
 class Indexer():
     def __init__(self, num_of_docs=100):
         self.num_of_docs=num_of_docs
         self.index = {}
+        # (html_file, folder) -> fingerprint of the files the document was built from, see documents.fingerprint
+        self.fingerprints = {}
+        # stem -> documents, for linker.find_sources
+        self.title_index = TitleIndex()
+        # the documents whose shards are to be written, and the documents to be removed from the store
+        self.dirty = set()
+        self.removed = set()
         self.pickle_name = "index"
+        self.stem_cache_name = "stems"
+
+    def pickle_path(self, name='default'):
+        return "{}_{}".format(self.pickle_name, name)
+
+    def store(self, name='default'):
+        return ShardedStore(self.pickle_path(name) + ".d")
+
+    def stem_cache_path(self, name='default'):
+        return "{}_{}".format(self.stem_cache_name, name)
 
     def pickle(self, name='default'):
-        with open("{}_{}".format(self.pickle_name, name), "wb") as fh:
-            pickle.dump(self.index, fh)
+        """Save the index in the sharded format (see storage.py): only the shards of the documents
+           parsed since the last save are written, the metadata table is written every time"""
+        stem_cache.save(self.stem_cache_path(name))
+        store = self.store(name)
+        # after a full run over an existing store nothing is known about the removed documents,
+        # so the saved table is compared with the index
+        for key in self.removed.union(store.keys()).difference(self.index):
+            store.remove_doc(key)
+        for key in self.dirty:
+            if key in self.index:
+                store.write_doc(key, self.index[key], unload=False)
+        store.write_meta(self.index, fingerprints=self.fingerprints, title_index=self.title_index,
+                         format=Document.FORMAT)
+        self.dirty = set()
+        self.removed = set()
 
     def unpickle(self, name='default'):
-        with open("{}_{}".format(self.pickle_name, name), "rb") as fh:
-            self.index = pickle.load(fh)
+        """Load the metadata of the index, the texts of the documents are loaded when they are needed"""
+        stem_cache.load(self.stem_cache_path(name))
+        store = self.store(name)
+        if store.exists():
+            self.index, tables = store.read_meta(Document)
+            self.fingerprints = tables["fingerprints"]
+            self.title_index = tables.get("title_index")
+            self.dirty = set()
+            if tables.get("format") != Document.FORMAT:
+                # the shards keep the paragraph table of a previous version, the documents are parsed again
+                for key, doc in self.index.items():
+                    doc._shard = None
+                    self.fingerprints.pop(key, None)
+        else:
+            self.unpickle_blob(name)
+        self.removed = set()
+        if self.title_index is None or len(self.title_index.order) != len(self.index):
+            self.title_index = TitleIndex(self.index)
+
+    def unpickle_blob(self, name='default'):
+        """the index saved as one pickle (with the parts flushed to separate files) by the previous versions"""
+        with open(self.pickle_path(name), "rb") as fh:
+            data = pickle.load(fh)
+        if "index" in data and "fingerprints" in data:
+            self.index = data["index"]
+            self.fingerprints = data["fingerprints"]
+            for part in data.get("parts", []):
+                with open(part, "rb") as fh:
+                    self.index.update(pickle.load(fh))
+            self.title_index = data.get("title_index")
+        else:
+            # an index pickled before fingerprints were introduced: everything counts as changed
+            self.index = data
+            self.fingerprints = {}
+            self.title_index = None
+        # nothing of it is in the sharded store yet
+        self.dirty = set(self.index)
+        # the documents pickled before the paragraph table existed can not be linked: forgetting their
+        # fingerprints makes the next incremental run parse them again
+        for key in self.legacy_docs():
+            self.fingerprints.pop(key, None)
+
+    def legacy_docs(self):
+        """the keys of the documents without the paragraph table, neither in memory nor in a shard"""
+        return [key for key, doc in self.index.items() if not doc.is_loaded("paragraphs") and not doc._shard]
+
+    def exists(self, name='default'):
+        return self.store(name).exists() or os.path.exists(self.pickle_path(name))
+
+    def flush(self, keys, name='default'):
+        """Write the shards of the freshly parsed documents and drop their texts from memory,
+           so that the memory of the parent process does not grow with the size of the collection"""
+        store = self.store(name)
+        for key in keys:
+            store.write_doc(key, self.index[key])
+            self.dirty.discard(key)
 
+    def drop_missing(self):
+        """forget the documents whose html-file (or the whole folder) has disappeared from the collection"""
+        for a_tuple in list(self.index):
+            html_file, folder = a_tuple
+            if not os.path.isfile(os.path.join(FOLDER, folder, html_file)):
+                del self.index[a_tuple]
+                self.fingerprints.pop(a_tuple, None)
+                self.dirty.discard(a_tuple)
+                self.removed.add(a_tuple)
 
-    def maybe_doc(self, a_tuple):
-        if a_tuple not in self.index:
-            return Document(a_tuple)
+    def changed_docs(self, docs):
+        """Yield the documents that are new or have changed since they were indexed.
+           A cheap stat is tried first, the files are hashed only if their mtime or size differ"""
+        for a_tuple in docs:
+            if a_tuple not in self.index:
+                yield a_tuple
+                continue
+            old = self.fingerprints.get(a_tuple)
+            if same_content(old, fingerprint(a_tuple)):
+                continue
+            new = fingerprint(a_tuple, digest=True)
+            if same_content(old, new):
+                # the files were touched, but their content is the same
+                self.fingerprints[a_tuple] = new
+                continue
+            del self.index[a_tuple]
+            yield a_tuple
 
     @timeit
-    def run(self):
+    def run(self, incremental=False, name='default', max_in_memory=None, processes=None, pool=None):
+        """Parse the documents into the index. In the incremental mode the saved index is loaded first
+           (unless it is already in memory), and only new or changed documents are parsed again.
+           With max_in_memory, the texts of parsed documents are written to their shards by portions of this size.
+           pool is a pool of workers started with init_stem_worker, which is kept running between the calls.
+           Returns the keys of the parsed and the removed documents"""
         docs = Docs(self.num_of_docs)
-        processes = cpu_count()
-        chunksize = 10
-        pool = Pool(processes=processes)
-        for maybe_doc in pool.map(self.maybe_doc, docs, chunksize=chunksize):
-            if maybe_doc:
-                self.index[(maybe_doc.html_file, maybe_doc.folder)] = maybe_doc
-        pool.close()
-        pool.join()
+        if incremental and not self.index and self.exists(name):
+            self.unpickle(name)
+        stem_cache.load(self.stem_cache_path(name))
+        self.drop_missing()
+        todo = list(self.changed_docs(docs))
+        # the documents without the paragraph table can not be saved, they are parsed again even if
+        # they are outside the selection of num_of_docs (the changed ones are in todo already)
+        legacy = self.legacy_docs()
+        todo.extend(legacy)
+        total = len(todo)
+        print ("{} documents to parse, {} up to date".format(total, len(self.index) - len(legacy)))
+        if not todo and not self.removed:
+            return set()
+        processes = processes or cpu_count()
+        chunksize = adaptive_chunksize(total, processes)
+        pending = []
+        own_pool = pool is None
+        if own_pool:
+            warm_up()
+            pool = Pool(processes=processes, initializer=init_stem_worker,
+                        initargs=(self.stem_cache_path(name), metrics.enabled))
+        for done, (a_tuple, new_fingerprint, doc, stems, records) in enumerate(pool.imap_unordered(parse_doc, todo, chunksize=chunksize), 1):
+            stem_cache.update(*stems)
+            metrics.merge(records)
+            self.fingerprints[a_tuple] = new_fingerprint
+            self.index[a_tuple] = doc
+            self.dirty.add(a_tuple)
+            pending.append(a_tuple)
+            if max_in_memory and len(pending) >= max_in_memory:
+                self.flush(pending, name)
+                pending = []
+            if done % PROGRESS_EVERY == 0 or done == total:
+                print ("{}/{} documents parsed".format(done, total))
+        if own_pool:
+            pool.close()
+            pool.join()
+        # the results come in arbitrary order, we restore the order of the collection
+        for a_tuple in todo:
+            self.index[a_tuple] = self.index.pop(a_tuple)
+        self.title_index = TitleIndex(self.index)
+        print ("stem cache: {hits} hits, {misses} misses, {size} of {maxsize} entries".format(**stem_cache.info()))
+        self.report_memory()
+        return set(todo) | self.removed
 
+    def report_memory(self):
+        number, total, mean, largest_key, largest, fields = memory_report(self.index)
+        print ("memory: {n} documents, {total} KB, {mean} KB per document, the largest is {key} ({largest} KB); {fields}".format(
+            n=number, total=total // 1024, mean=mean // 1024, key=largest_key, largest=largest // 1024,
+            fields=", ".join("{} {} KB".format(name, size // 1024) for name, size in fields.items())))
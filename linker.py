@@ -1,42 +1,159 @@
 import os
 import re
-from bs4 import element
 from collections import namedtuple
+from multiprocessing import Pool
 
-from utils import normalize, letters_only, clean_amendment, word_intersection
-from documents import FOLDER
+from utils import letters_only, clean_amendment, found_in, adaptive_chunksize, warm_up
+from title_index import TitleIndex
+from paragraphs import previous_siblings, paragraph_text
+from splice import link_paragraph, write_new_html, remove_new_html
+from replacements import ShortReplacements
+from metrics import metrics, init_metrics_worker
 
 MARKER_TEXT = u'в следующей редакции'
 
 """Единственная функция, которую мы отсюда импортирируем, это add_links. Она обрабатывает все документы в индексе.
 
-В функции add_links итеририруемся по всем документам и для каждого документа, который является "изменением и дополнением", генерируем гипотезы - пары (регулярное выражение, документ).
+В функции add_links итеририруемся по всем документам и для каждого документа, который является "изменением и дополнением", находим основные документы (find_sources) и генерируем гипотезы - пары (регулярное выражение, документ).
 Гипотезы документов генерирует функция gen_matches следующим образом: если документ является "изменениями и дополнениями", она ищет возможные основные документы к этим изменениям и дополнениям  (проходит по всем заголовкам и находит относительно похожие).
 Регулярные выражения в этих гипотезах порождаются так: находим в "изменениях и дополнениях" текст "в следующей редакции" и выделяем то, что стоит в кавычках после него. Кусок текста в кавычках разбиваем на фрагменты по разделителю параграфов (что-то вроде "2.3.14") и строим регулярку из содержимого параграфа. Разбивку на фрагменты и порождение регулярки осуществляет функция text_to_patterns. При этом мы работаем не с html, а с относительно чистым текстом (который возвращает атрибут .text у BeautifulSoup). Однако этот текст недостаточно чистый, все равно понадобились какие-то ухищрения для его нормализации. В основном работали функции clean_amendment (в частности, убирает нумерацию параграфов) и normalize, однако в результате и их оказалось недостаточно для некоторых случаев, поэтому я начал нормализовывать, просто оставляя строки только из букв.
 Далее, когда мы породили гипотезы, основываясь на нормализованном тексте, нужно применить эти гипотезы к реальным html-документам.
 process_target_html извлекает имя параграфа "изменений и дополнений", на который нужно сослаться (если в текущем html нет подходящего имени параграфа, будем ссылаться на документ в целом). 
-modify_source_html модифицирует html-дерево (в формате BeutifulSoup) основного документа, в который нужно вставить ссылки. В последнем цикле сохраняем документы под новыми именами.
+modify_source_html порождает правки html основного документа, в который нужно вставить ссылки (см. splice.py). В последнем цикле применяем все правки каждого документа и сохраняем документы под новыми именами.
+"Изменения и дополнения" обрабатываются независимо друг от друга (link_task), поэтому их можно раздать пулу процессов (processes > 1); правки собираются в порядке документов, так что результат не зависит от числа процессов.
+Короткие замены ("Заменить ... словосочетание «...» на «...»", см. replacements.py) ищутся после этого, задачей на каждый основной документ (replacement_task): его абзацы просматриваются один раз на словосочетания всех изменений к нему.
 """
 
-def add_links(index):
+def add_links(index, title_index=None, processes=1, changed=None, previous=None):
+    """changed: the keys of the documents parsed again or removed since the last linking; if given,
+       only the sources affected by them are linked and rewritten (see affected_tasks).
+       previous: what link_sources returned for the index before these changes.
+       Returns link_sources of the index, to be passed as previous next time"""
     # folder, fname = ("D138D5D36436D0CA442579E900265CF8", "201_2012Н.html")
     # target = index.get((fname, folder))
     # if target:
-    for target in index.values():
-        modified = set()
-        marker_text = MARKER_TEXT
-        for pattern, source in gen_matches(index, target, marker_text):
+    if title_index is None:
+        title_index = TitleIndex(index)
+    # the amendments are independent: each task is an amendment with its sources, and the result is the edits
+    current = link_sources(index, title_index)
+    tasks = list(current.items())
+    if changed is not None:
+        touched = touched_sources(current, previous or {}, changed)
+        tasks = affected_tasks(tasks, touched)
+    with metrics.timer("short replacements"):
+        replacements = ShortReplacements(index, tasks)
+    if processes > 1:
+        warm_up(tokenizer=False)
+        pool = Pool(processes=processes, initializer=init_link_worker, initargs=(index, replacements, metrics.enabled))
+        results = pool.imap(link_task, tasks, chunksize=adaptive_chunksize(len(tasks), processes))
+    else:
+        init_link_worker(index, replacements)
+        results = map(link_task, tasks)
+    # the edits of all the amendments are collected for each source in the order of the amendments,
+    # so the result does not depend on the number of processes, and each source is written once
+    modified = {}
+    for source_edits, records in results:
+        metrics.merge(records)
+        for key, edits in source_edits:
+            modified.setdefault(key, []).extend(edits)
+    # the links of the short replacements go after those of the quoted paragraphs, see splice.select_edits
+    source_keys = list(replacements.sources)
+    if processes > 1:
+        results = pool.imap(replacement_task, source_keys, chunksize=adaptive_chunksize(len(source_keys), processes))
+    else:
+        results = map(replacement_task, source_keys)
+    for key, (edits, records) in zip(source_keys, results):
+        metrics.merge(records)
+        if edits:
+            modified.setdefault(key, []).extend(edits)
+    if processes > 1:
+        pool.close()
+        pool.join()
+    for key, edits in modified.items():
+        write_new_html(index[key], edits)
+    if changed is not None:
+        # the sources which have lost all their links: an amendment was removed or does not refer to them now
+        linked = all_sources(current) | all_sources(previous or {})
+        for key in touched.difference(modified).intersection(linked):
+            remove_new_html(key)
+    return current
+
+def link_sources(index, title_index):
+    """amendment key -> the keys of its sources, for the amendments which have sources"""
+    result = {}
+    for key, target in index.items():
+        if target.is_amendment:
+            sources = find_sources(index, target, title_index)
+            if sources:
+                result[key] = [(source.html_file, source.folder) for source in sources]
+    return result
+
+def all_sources(sources_map):
+    return {key for source_keys in sources_map.values() for key in source_keys}
+
+def touched_sources(current, previous, changed):
+    """The changed documents and the sources of the changed amendments, both the present ones and those
+       the amendments had before the change (their links must go away). An amendment may change its sources
+       without being changed itself, when a main document is added, removed or retitled, so the sources of
+       every amendment whose sources differ are touched too"""
+    changed = set(changed)
+    touched = set(changed)
+    for key in changed.union(current, previous):
+        if key in changed or current.get(key) != previous.get(key):
+            touched.update(current.get(key, ()))
+            touched.update(previous.get(key, ()))
+    return touched
+
+def affected_tasks(tasks, touched):
+    """A source is written once with the links of all its amendments, so the touched sources (see touched_sources)
+       are linked again with all their amendments; the other sources are left as they are"""
+    return [(key, [source_key for source_key in source_keys if source_key in touched])
+            for key, source_keys in tasks if touched.intersection(source_keys)]
+
+# the index and the short replacements of the process doing the linking, see init_link_worker
+link_index = {}
+link_replacements = None
+
+def init_link_worker(index, replacements=None, measure=None):
+    """The pool initializer: the index is passed to each worker once (with fork it is not even copied),
+       and the tasks refer to the documents by their keys"""
+    global link_index, link_replacements
+    link_index = index
+    link_replacements = replacements
+    if measure is not None:
+        # in a worker process, not in the main one
+        init_metrics_worker(measure)
+        warm_up(tokenizer=False)
+
+def link_task(task):
+    """edits for the sources of one amendment: ([(source key, edits)], metrics of the worker)"""
+    target_key, source_keys = task
+    with metrics.document("link", target_key):
+        target = link_index[target_key]
+        sources = [link_index[key] for key in source_keys]
+        result = list(amendment_edits(target, sources).items())
+    return result, metrics.drain()
+
+def replacement_task(source_key):
+    """edits for the short replacements in one source: (edits, metrics of the worker)"""
+    with metrics.document("replacements", source_key):
+        edits = link_replacements.source_edits(link_index[source_key], source_key)
+    return edits, metrics.drain()
+
+def amendment_edits(target, sources, marker_text=MARKER_TEXT):
+    result = {}
+    with metrics.timer("gen_matches"):
+        hypotheses = list(gen_matches(None, target, marker_text, sources=sources))
+    for pattern, source in hypotheses:
+        with metrics.timer("process_target_html"):
             paragraph = process_target_html(pattern, target, marker_text)
-            modify_source_html(pattern, source, target, paragraph)
-            modified.add(source)
-        for doc in modified:
-            current_fname = os.path.join(FOLDER, doc.folder, doc.html_file)
-            new_fname = current_fname.replace(".html", "_new.html")
-            with open(new_fname, 'w') as fh:
-                fh.write(doc.soup.prettify())
-                print (new_fname)
-
-def gen_matches(index, target_doc, marker_text):
+        with metrics.timer("modify_source_html"):
+            edits = modify_source_html(pattern, source, target, paragraph)
+        if edits:
+            result.setdefault((source.html_file, source.folder), []).extend(edits)
+    return result
+
+def gen_matches(index, target_doc, marker_text, title_index=None, sources=None):
        def text_to_patterns(txt):
             paragraph = "\d\d?\.\d\d?\.\d\d?\."
             for partition in re.split(paragraph, txt):
@@ -50,34 +167,46 @@ def gen_matches(index, target_doc, marker_text):
        marker_text = "[\n\s]*".join(marker_text.split())
        quoted_pattern = re.compile(u"{}:[\n\s]*«(.*?)»".format(marker_text), re.MULTILINE | re.DOTALL)
        if target_doc.is_amendment:
-             sources = find_sources(index, target_doc)
-             for match in re.finditer(quoted_pattern, target_doc.text):
-                     txt = clean_amendment(match[1])
-                     for source in sources:
-                         found = letters_only(txt) in letters_only(normalize(source.text))
-                         if found:
+             quotes = [clean_amendment(match[1]) for match in re.finditer(quoted_pattern, target_doc.text)]
+             if not quotes:
+                 return
+             if sources is None:
+                 sources = find_sources(index, target_doc, title_index)
+             keys = [letters_only(txt) for txt in quotes]
+             # all the quotes are looked for in the cached letters-only text of each source at once
+             found = [found_in(keys, source.letters) for source in sources]
+             for txt, key in zip(quotes, keys):
+                     for source, found_keys in zip(sources, found):
+                         if key in found_keys:
                             for pattern in text_to_patterns(txt):
+                                metrics.count("hypotheses")
                                 yield (pattern, source)
 
-def find_sources(index, amendment):
+def find_sources(index, amendment, title_index=None):
     """Given an amendment ("изменения и дополнения") document, which will be the target of the links,
        find the best sources of the links - that is, the documents the titles of which contain more or less
-       the same bag of words. We are not trying to find only one source"""
+       the same bag of words. We are not trying to find only one source.
+       The candidates are collected from the posting lists of the title index, so only the documents
+       sharing at least one stem with the amendment's title are looked at"""
     the_least_intersection = 10
     # the first value is for soring, two other numbers for debugging only.
     # the function returns only documents
     Source = namedtuple("Source", "sorting_key intersection_len intersection_to_source_title source_doc")
+    if not amendment.main_doc_title:
+        return []
+    if title_index is None:
+        title_index = TitleIndex(index)
     possible_sources = []
-    for doc in index.values():
-        if not doc.is_amendment:
-            intersection_len = len(word_intersection(amendment.main_doc_title.split(), doc.clean_title.split()))
-            if intersection_len > the_least_intersection:
-                    # we will not compare the intersection length to the length of the amendment title, because it 
-                    # also contains some part as "введенную в действие приказом от ...."
-                    doc_title_len = len(set(doc.clean_title.split()))
-                    prop = intersection_len / doc_title_len
-                    maybe_source = Source(intersection_len+prop, intersection_len, prop, doc)
-                    possible_sources.append(maybe_source)
+    for key, intersection_len in title_index.intersections(amendment.main_doc_title.split()).items():
+        if intersection_len > the_least_intersection and key in index:
+                # we will not compare the intersection length to the length of the amendment title, because it 
+                # also contains some part as "введенную в действие приказом от ...."
+                prop = intersection_len / title_index.title_sizes[key]
+                maybe_source = Source(intersection_len+prop, intersection_len, prop, key)
+                possible_sources.append(maybe_source)
+    # the documents with equal scores go in the order of the index
+    possible_sources.sort(key=lambda x: title_index.order[x.source_doc])
+    possible_sources = [elem._replace(source_doc=index[elem.source_doc]) for elem in possible_sources]
     sorted_sources = sorted(possible_sources, key=lambda x: x.sorting_key, reverse=True)
     if sorted_sources:
         # we get all documents with the same highest score
@@ -89,60 +218,47 @@ def find_sources(index, amendment):
 
 
 def modify_source_html(pattern, source, target, paragraph):
-    def add_link_to_element(elem, link_url):
-       modified = False
-       for a in elem.find_all('a'):
-            a["href"] = link_url
-            modified = True
-       if not modified:
-           txt = elem.text
-           new_tag = source.soup.new_tag("a", href=link_url)
-           new_tag.string = txt
-           child = list(elem.children)[0]
-           # a rather cruel way of modification, that does not preserve the inner structure, if present
-           if isinstance(child, element.Tag):
-               child.clear()
-               child.append(new_tag)
-           else:
-               elem.clear()
-               elem.append(new_tag)
-
-    source.get_soup()
-    for p in source.soup.find_all('p'):
-        if re.search(pattern, p.text):
-            target_fname = os.path.join(target.folder, target.html_file)
-            link_url = "../{}#{}".format(target_fname, paragraph or "")
-            add_link_to_element(p, link_url)
+    """The links to the target for the paragraphs of the source matching the pattern,
+       as edits of the source html (see splice.py)"""
+    target_fname = os.path.join(target.folder, target.html_file)
+    link_url = "../{}#{}".format(target_fname, paragraph or "")
+    edits = []
+    for p, text in source.paragraph_texts():
+        if re.search(pattern, text):
+            metrics.count("regex matches")
+            edits.extend(link_paragraph(p, link_url))
+    return edits
 
 
 def process_target_html(pattern, target, marker_text):
     """Unofortunately, we can not use construction like 
          target.soup.find('p', text=pattern)
-    because it can not find text inside some structure of span's inside"""
+    because it can not find text inside some structure of span's inside.
+    The paragraphs come from the table built at indexing time (see paragraphs.py), so the html
+    of the target is not parsed at all; siblings are the paragraphs with the same parent"""
     
-    def find_target(elem, target):    
+    def find_target(i, target):    
         """The target text might be not precisely in the previous paragraph, so we loop to find it"""
-        while True and elem:
-            previous = elem.find_previous_sibling()
-            if previous and (target in previous.text):
+        siblings = previous_siblings(paragraphs, i)
+        for previous in siblings:
+            if target in paragraph_text(text, previous):
                 name = ""
-                if previous.a:
-                    name = previous.find('a').get('name')
+                if previous.links:
+                    name = previous.name
                 else:
                     # additionally, we can shift left exactly once, in case the target paragraph does not 
                     # contain name
-                    prev = previous.find_previous_sibling()
-                    if prev and prev.a:
-                        name = prev.find('a').get('name')
+                    prev = next(siblings, None)
+                    if prev and prev.links:
+                        name = prev.name
                 return name
-            else:
-                elem = previous
     
-    target.get_soup()
-    for elem in target.soup.find_all('p'):
-        match = re.search(pattern, elem.text)
+    paragraphs = target.paragraphs
+    text = target.text
+    for i, elem in enumerate(paragraphs):
+        match = re.search(pattern, paragraph_text(text, elem))
         if match:
-            return find_target(elem, target=marker_text)
+            return find_target(i, target=marker_text)
 
 
 
@@ -0,0 +1,181 @@
+import contextlib
+import cProfile
+import json
+import math
+import os
+import sys
+import time
+from collections import Counter
+
+"""Замеры: вложенные таймеры, счетчики и стоимость обработки каждого документа по этапам.
+По умолчанию выключены, и тогда timer и count ничего не делают; включаются из run.py (--metrics).
+Таймеры вкладываются друг в друга: время записывается по пути из имен открытых таймеров, например
+links/link/gen_matches. Рабочие процессы пула копят свои замеры и отдают их вместе с результатом задачи
+(drain), родитель добавляет их к пути своего открытого таймера (merge).
+Для отдельных этапов можно записать профиль cProfile (--profile); профилируется только основной процесс,
+так что для расстановки ссылок нужно запускать ее в одном процессе (-j 1).
+"""
+
+SLOWEST = 10
+
+
+def percentile(values, q):
+    """nearest-rank percentile of the sorted values"""
+    if not values:
+        return None
+    k = max(math.ceil(q / 100 * len(values)) - 1, 0)
+    return values[min(k, len(values) - 1)]
+
+
+class Metrics():
+    def __init__(self):
+        self.enabled = False
+        # path of the timer names -> [calls, seconds]
+        self.timers = {}
+        self.counters = Counter()
+        # stage -> [(seconds, key of the document)]
+        self.documents = {}
+        self.stack = []
+        # the names of the timers to profile, and the directory for the profiles
+        self.profiled = set()
+        self.profile_dir = "."
+        self.profiler = None
+
+    def enable(self, profile=(), profile_dir="."):
+        self.enabled = True
+        self.profiled = set(profile)
+        self.profile_dir = profile_dir
+
+    def reset(self):
+        self.timers = {}
+        self.counters = Counter()
+        self.documents = {}
+
+    @contextlib.contextmanager
+    def measure(self, name):
+        self.stack.append(name)
+        path = tuple(self.stack)
+        profiler = None
+        if name in self.profiled and self.profiler is None:
+            profiler = self.profiler = cProfile.Profile()
+            profiler.enable()
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - begin
+            if profiler:
+                profiler.disable()
+                self.profiler = None
+                self.dump_profile(name, profiler)
+            self.stack.pop()
+            self.add_time(path, seconds)
+
+    def timer(self, name):
+        """a context manager; the time goes to the path of all the open timers"""
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self.measure(name)
+
+    @contextlib.contextmanager
+    def measure_document(self, stage, key):
+        begin = time.perf_counter()
+        with self.measure(stage):
+            yield
+        self.documents.setdefault(stage, []).append((time.perf_counter() - begin, key))
+
+    def document(self, stage, key):
+        """a timer which also records the cost of the document in the stage"""
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self.measure_document(stage, key)
+
+    def add_time(self, path, seconds, calls=1):
+        elem = self.timers.setdefault(path, [0, 0.0])
+        elem[0] += calls
+        elem[1] += seconds
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] += n
+
+    def drain(self):
+        """The records of a pool worker since the previous call, to be returned with the result of the task.
+           Inside an open timer (the task is run by the main process itself) the records are already
+           where they belong, and None is returned"""
+        if not self.enabled or self.stack:
+            return None
+        result = (self.timers, dict(self.counters), self.documents)
+        self.reset()
+        return result
+
+    def merge(self, records):
+        """add the records of a worker, its timers go under the open timers of this process"""
+        if not records:
+            return
+        timers, counters, documents = records
+        prefix = tuple(self.stack)
+        for path, (calls, seconds) in timers.items():
+            self.add_time(prefix + path, seconds, calls)
+        self.counters.update(counters)
+        for stage, costs in documents.items():
+            self.documents.setdefault(stage, []).extend(costs)
+
+    def dump_profile(self, name, profiler):
+        fname = os.path.join(self.profile_dir, "profile_{}.prof".format(name))
+        profiler.dump_stats(fname)
+        print ("profile of {} is saved to {}".format(name, fname), file=sys.stderr)
+
+    def document_stats(self, stage):
+        costs = sorted(self.documents[stage])
+        seconds = [elem[0] for elem in costs]
+        return {"documents": len(costs), "total": sum(seconds), "p50": percentile(seconds, 50),
+                "p95": percentile(seconds, 95), "max": seconds[-1] if seconds else None,
+                "slowest": [{"key": list(key), "seconds": cost} for cost, key in reversed(costs[-SLOWEST:])]}
+
+    def as_dict(self):
+        return {"timers": [{"path": "/".join(path), "calls": calls, "seconds": seconds}
+                           for path, (calls, seconds) in sorted(self.timers.items())],
+                "counters": dict(self.counters),
+                "documents": {stage: self.document_stats(stage) for stage in self.documents}}
+
+    def summary(self):
+        lines = ["timers:"]
+        for path, (calls, seconds) in sorted(self.timers.items()):
+            name = "  " * len(path) + path[-1]
+            lines.append("{:<40} {:>8} calls {:12.3f} s".format(name, calls, seconds))
+        lines.append("counters:")
+        for name, value in sorted(self.counters.items()):
+            lines.append("  {:<38} {:>8}".format(name, value))
+        lines.append("documents:")
+        for stage in self.documents:
+            stats = self.document_stats(stage)
+            lines.append("  {stage}: {documents} documents, p50 {p50:.4f} s, p95 {p95:.4f} s, max {max:.4f} s".format(
+                stage=stage, **stats))
+            for elem in stats["slowest"]:
+                lines.append("    {:10.4f} s  {}".format(elem["seconds"], os.path.join(*reversed(elem["key"]))))
+        return "\n".join(lines)
+
+    def report(self, fmt="summary", path=None):
+        """print the summary or dump the json, to the file or to stderr"""
+        if not self.enabled:
+            return
+        text = json.dumps(self.as_dict(), indent=2, ensure_ascii=False) if fmt == "json" else self.summary()
+        if path:
+            with open(path, "w", encoding="utf-8") as fh:
+                fh.write(text)
+        else:
+            print (text, file=sys.stderr)
+
+
+metrics = Metrics()
+
+def init_metrics_worker(enabled):
+    """A part of the pool initializers: with spawn the workers do not inherit the switch, with fork
+       they inherit the records and the open timers of the parent, which must not be sent back"""
+    if metrics.profiler:
+        metrics.profiler.disable()
+        metrics.profiler = None
+    metrics.enabled = enabled
+    metrics.stack = []
+    metrics.reset()
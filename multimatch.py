@@ -0,0 +1,113 @@
+import re
+from collections import deque
+from utils import stem
+
+# the words with their inner dots and hyphens: "170-И", "12.03.2017", "г" (without the final dot)
+TOKEN = re.compile(r"\w+(?:[-./]\w+)*")
+
+
+def token_key(token):
+    return token.rstrip(".")
+
+
+def stemmed_tokens(text):
+    """(stem, start, end) for the words of the text"""
+    return [(token_key(stem(m[0])), m.start(), m.end()) for m in TOKEN.finditer(text)]
+
+
+class Automaton():
+    """Aho-Corasick automaton over sequences of any hashable symbols (here - the stems of the words).
+       All the occurrences of all the patterns are found in one pass over the sequence"""
+    def __init__(self):
+        self.goto = [{}]
+        self.fail = [0]
+        # (length of the pattern, value) for the nodes where a pattern ends
+        self.out = [None]
+        # the nearest node with an output along the chain of failure links
+        self.output_link = [0]
+        self.built = False
+
+    def __len__(self):
+        return sum(1 for elem in self.out if elem)
+
+    def add(self, pattern, value):
+        node = 0
+        for symbol in pattern:
+            next_node = self.goto[node].get(symbol)
+            if next_node is None:
+                next_node = len(self.goto)
+                self.goto[node][symbol] = next_node
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append(None)
+                self.output_link.append(0)
+            node = next_node
+        self.out[node] = (len(pattern), value)
+        self.built = False
+
+    def build(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for symbol, child in self.goto[node].items():
+                state = self.fail[node]
+                while state and symbol not in self.goto[state]:
+                    state = self.fail[state]
+                fail = self.goto[state].get(symbol, 0)
+                self.fail[child] = fail
+                self.output_link[child] = fail if self.out[fail] else self.output_link[fail]
+                queue.append(child)
+        self.built = True
+
+    def iter(self, sequence):
+        """(start, end, value) for every occurrence of every pattern, in the order of the ends"""
+        if not self.built:
+            self.build()
+        goto, fail, out, output_link = self.goto, self.fail, self.out, self.output_link
+        state = 0
+        for i, symbol in enumerate(sequence):
+            while state and symbol not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(symbol, 0)
+            node = state if out[state] else output_link[state]
+            while node:
+                length, value = out[node]
+                yield (i + 1 - length, i + 1, value)
+                node = output_link[node]
+
+    def longest(self, sequence):
+        """the leftmost longest occurrences which do not overlap"""
+        result = []
+        last_end = 0
+        for start, end, value in sorted(self.iter(sequence), key=lambda x: (x[0], -x[1])):
+            if start >= last_end:
+                result.append((start, end, value))
+                last_end = end
+        return result
+
+
+class PhraseMatcher():
+    """Finds the phrases in the text word by word, so that any form of the words with the same stem matches.
+       The phrases and the text are split into words in the same way. Returns character offsets"""
+    def __init__(self, phrases, min_tokens=1):
+        self.automaton = Automaton()
+        for phrase, value in phrases:
+            tokens = [token[0] for token in stemmed_tokens(phrase)]
+            if len(tokens) >= min_tokens:
+                self.automaton.add(tokens, value)
+        self.automaton.build()
+
+    def __len__(self):
+        return len(self.automaton)
+
+    def find(self, text):
+        """(start, end, value) of the non-overlapping longest occurrences in the text"""
+        tokens = stemmed_tokens(text)
+        return [(tokens[start][1], tokens[end - 1][2], value)
+                for start, end, value in self.automaton.longest(token[0] for token in tokens)]
+
+    def find_all(self, text):
+        """(start, end, value) of all the occurrences, the overlapping ones too, in the order of their ends"""
+        tokens = stemmed_tokens(text)
+        return [(tokens[start][1], tokens[end - 1][2], value)
+                for start, end, value in self.automaton.iter([token[0] for token in tokens])]
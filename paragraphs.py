@@ -0,0 +1,281 @@
+import html
+import re
+import sys
+from array import array
+from bisect import bisect_right
+from collections import namedtuple
+from html.parser import HTMLParser
+
+"""Таблица абзацев документа: для каждого <p> храним его текст, смещения в исходном html и ближайшее
+предшествующее имя <a name=...>. Таблица строится один раз при индексации, и на этапе расстановки ссылок
+html разбирать уже не нужно.
+Смещения - это позиции в раскодированной строке html (как ее читает Document.read_html).
+Тот же проход по html собирает и полный текст документа (extract), так что дерево BeautifulSoup при индексации
+не нужно. Текст абзаца - это кусок полного текста, и в таблице хранятся только его границы (text_start, text_end),
+а не отдельная копия; сам текст берется срезом (paragraph_text). Сама таблица (ParagraphTable) хранится
+по столбцам в массивах чисел, записи Paragraph создаются при обращении к ним.
+"""
+
+# BeautifulSoup leaves their content out of .text
+SKIPPED_TAGS = ("script", "style", "template")
+PRESERVED_TAGS = ("pre", "textarea")
+ASCII_SPACES = " \n\t\x0c\r"
+NEWLINE = re.compile("\r\n?")
+VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param", "source", "track", "wbr"}
+
+# text_start, text_end - the text of the paragraph in the text of the document, the same as the .text
+# of the <p> in BeautifulSoup
+# start, end - the <p> element in the html, inner_start, inner_end - its content without the tags of <p>
+# parent - the number of the parent element, the paragraphs with the same parent are siblings
+# links - (start, end) of the start tags of all the <a> inside the paragraph
+# name - the name of the first <a> inside the paragraph (None if there is no <a> or it has no name)
+# anchor - the nearest name of <a name=...> before the end of the paragraph
+# segments - (text_start, html_start, html_end) of the pieces of text, to map the text back to the html;
+# text_start is counted from the beginning of the paragraph, the triples are flattened into one array
+Paragraph = namedtuple("Paragraph", "text_start text_end start end inner_start inner_end parent links name anchor segments")
+SEGMENT = 3
+# the offsets in the arrays of the table: a html-document is far shorter than 2 GB
+TYPECODE = "i"
+
+
+class ParagraphScanner(HTMLParser):
+    def __init__(self, source):
+        super().__init__(convert_charrefs=False)
+        self.source = source
+        self.line_starts = [0]
+        pos = source.find("\n")
+        while pos != -1:
+            self.line_starts.append(pos + 1)
+            pos = source.find("\n", pos + 1)
+        # the stack of the open elements: (tag, number of the element)
+        self.stack = []
+        self.elements = 0
+        self.open_paragraphs = []
+        self.paragraphs = []
+        self.anchor = None
+        # the text of the whole document, the same as .text of BeautifulSoup
+        self.text_parts = []
+        self.text_length = 0
+        self.pending = []
+
+    def position(self):
+        lineno, col = self.getpos()
+        return self.line_starts[lineno - 1] + col
+
+    def handle_starttag(self, tag, attrs):
+        self.flush_text()
+        start = self.position()
+        end = start + len(self.get_starttag_text())
+        if tag == "a":
+            name = dict(attrs).get("name")
+            for p in self.open_paragraphs:
+                if not p["links"]:
+                    p["name"] = name
+                p["links"].append((start, end))
+            if name:
+                self.anchor = name
+        if tag == "p":
+            parent = self.stack[-1][1] if self.stack else 0
+            self.open_paragraphs.append({"start": start, "inner_start": end, "parent": parent, "links": [],
+                                         "name": None, "text_start": self.text_length, "segments": [],
+                                         "number": len(self.paragraphs)})
+            # a placeholder, to keep the paragraphs in the order of their start tags
+            self.paragraphs.append(None)
+        if tag not in VOID_TAGS:
+            self.elements += 1
+            self.stack.append((tag, self.elements))
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_TAGS:
+            end = self.position() + len(self.get_starttag_text())
+            self.close_element(tag, end, end)
+
+    def handle_endtag(self, tag):
+        self.flush_text()
+        start = self.position()
+        end = self.source.find(">", start)
+        end = len(self.source) if end == -1 else end + 1
+        self.close_element(tag, start, end)
+
+    def close_element(self, tag, inner_end, end):
+        if not any(elem[0] == tag for elem in self.stack):
+            return
+        while self.stack:
+            closed, _ = self.stack.pop()
+            if closed == "p":
+                self.finish(self.open_paragraphs.pop(), inner_end, end)
+            if closed == tag:
+                break
+
+    def finish(self, p, inner_end, end):
+        self.paragraphs[p["number"]] = Paragraph(p["text_start"], self.text_length, p["start"], end,
+                                                 p["inner_start"], inner_end, p["parent"], tuple(p["links"]),
+                                                 p["name"], self.anchor, p["segments"])
+
+    def add_text(self, text, html_start, html_end):
+        # the pieces of one text node are collected until the next tag, see flush_text
+        self.pending.append((text, html_start, html_end))
+
+    def flush_text(self):
+        pieces = self.pending
+        if not pieces:
+            return
+        self.pending = []
+        if self.stack and self.stack[-1][0] in SKIPPED_TAGS:
+            return
+        if not any(elem[0] in PRESERVED_TAGS for elem in self.stack) and \
+                not "".join(piece[0] for piece in pieces).strip(ASCII_SPACES):
+            # as BeautifulSoup does, a node of whitespace only becomes a single newline or space
+            text = "\n" if any("\n" in piece[0] for piece in pieces) else " "
+            pieces = [(text, pieces[0][1], pieces[-1][2])]
+        for text, html_start, html_end in pieces:
+            for p in self.open_paragraphs:
+                p["segments"].extend((self.text_length - p["text_start"], html_start, html_end))
+            self.text_parts.append(text)
+            self.text_length += len(text)
+
+    def handle_comment(self, data):
+        self.flush_text()
+
+    def handle_decl(self, decl):
+        self.flush_text()
+
+    def handle_pi(self, data):
+        self.flush_text()
+
+    def unknown_decl(self, data):
+        self.flush_text()
+        if data.upper().startswith("CDATA["):
+            # BeautifulSoup keeps the content of CDATA in the text, as a separate node
+            start = self.position()
+            self.add_text(data[len("CDATA["):], start, start + len(data) + len("<![]]>"))
+            self.flush_text()
+
+    def handle_data(self, data):
+        start = self.position()
+        if "\r" not in data:
+            self.add_text(data, start, start + len(data))
+            return
+        # the text is the same as if the file were read with the universal newlines, as it used to be
+        pos = 0
+        for newline in NEWLINE.finditer(data):
+            if newline.start() > pos:
+                self.add_text(data[pos:newline.start()], start + pos, start + newline.start())
+            self.add_text("\n", start + newline.start(), start + newline.end())
+            pos = newline.end()
+        if pos < len(data):
+            self.add_text(data[pos:], start + pos, start + len(data))
+
+    def handle_entityref(self, name):
+        text = html.unescape("&{};".format(name))
+        # BeautifulSoup leaves the unknown entities as they are, but without the semicolon
+        self.handle_ref("&" + name, text if text != "&{};".format(name) else "&" + name)
+
+    def handle_charref(self, name):
+        self.handle_ref("&#" + name, html.unescape("&#{};".format(name)))
+
+    def handle_ref(self, raw, text):
+        start = self.position()
+        end = start + len(raw)
+        if self.source.startswith(";", end):
+            end += 1
+        self.add_text(text, start, end)
+
+    def scan(self):
+        self.feed(self.source)
+        self.close_all()
+        return ParagraphTable(self.paragraphs)
+
+    def close_all(self):
+        super().close()
+        self.flush_text()
+        while self.open_paragraphs:
+            self.finish(self.open_paragraphs.pop(), len(self.source), len(self.source))
+
+
+class ParagraphTable():
+    """The paragraph table in columns: a few arrays of numbers for the whole document instead of a tuple
+       with a dozen objects per paragraph. Indexing and iteration give the Paragraph records"""
+    COLUMNS = ("text_start", "text_end", "start", "end", "inner_start", "inner_end", "parent")
+    # the segments and the links of the i-th paragraph are segments[segment_bounds[i]:segment_bounds[i + 1]],
+    # links[link_bounds[i]:link_bounds[i + 1]], both flattened
+    __slots__ = COLUMNS + ("segment_bounds", "segments", "link_bounds", "links", "names", "anchors")
+
+    def __init__(self, paragraphs=()):
+        for name in self.COLUMNS:
+            setattr(self, name, array(TYPECODE))
+        self.segment_bounds = array(TYPECODE, [0])
+        self.segments = array(TYPECODE)
+        self.link_bounds = array(TYPECODE, [0])
+        self.links = array(TYPECODE)
+        self.names = []
+        self.anchors = []
+        for paragraph in paragraphs:
+            self.append(paragraph)
+
+    def append(self, paragraph):
+        for name in self.COLUMNS:
+            getattr(self, name).append(getattr(paragraph, name))
+        self.segments.extend(paragraph.segments)
+        self.segment_bounds.append(len(self.segments))
+        for link in paragraph.links:
+            self.links.extend(link)
+        self.link_bounds.append(len(self.links))
+        self.names.append(paragraph.name)
+        self.anchors.append(paragraph.anchor)
+
+    def __len__(self):
+        return len(self.text_start)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        links = self.links[self.link_bounds[i]:self.link_bounds[i + 1]]
+        return Paragraph(self.text_start[i], self.text_end[i], self.start[i], self.end[i], self.inner_start[i],
+                         self.inner_end[i], self.parent[i], tuple(zip(links[::2], links[1::2])), self.names[i],
+                         self.anchors[i], self.segments[self.segment_bounds[i]:self.segment_bounds[i + 1]])
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def __sizeof__(self):
+        """with the arrays and the names, so that sys.getsizeof (and utils.deep_sizeof) counts the whole table"""
+        strings = {id(elem): elem for elem in self.names + self.anchors if elem is not None}
+        return (object.__sizeof__(self) + sum(sys.getsizeof(getattr(self, name)) for name in self.__slots__) +
+                sum(sys.getsizeof(elem) for elem in strings.values()))
+
+
+def extract(source):
+    """(the text of the document, the paragraph table) in one pass, without building a tree"""
+    scanner = ParagraphScanner(source)
+    paragraphs = scanner.scan()
+    return "".join(scanner.text_parts), paragraphs
+
+
+def paragraph_text(text, paragraph):
+    """text - the text of the document"""
+    return text[paragraph.text_start:paragraph.text_end]
+
+
+def previous_siblings(paragraphs, i):
+    """the paragraphs before the i-th one with the same parent, nearest first"""
+    parents = paragraphs.parent
+    for j in range(i - 1, -1, -1):
+        if parents[j] == parents[i]:
+            yield paragraphs[j]
+
+
+def html_offset(paragraph, pos):
+    """the position in the html corresponding to the position in the text of the paragraph"""
+    segments = paragraph.segments
+    if not segments:
+        return paragraph.inner_start
+    starts = segments[::SEGMENT]
+    k = max(bisect_right(starts, pos) - 1, 0)
+    text_start, html_start, html_end = segments[k * SEGMENT:(k + 1) * SEGMENT]
+    text_end = starts[k + 1] if k + 1 < len(starts) else paragraph.text_end - paragraph.text_start
+    if html_end - html_start == text_end - text_start:
+        return html_start + min(max(pos - text_start, 0), html_end - html_start)
+    # an entity can not be split, for it the text and the html are of different length
+    return html_start if pos <= text_start else html_end
@@ -0,0 +1,126 @@
+import os
+import re
+from collections import namedtuple
+from multimatch import PhraseMatcher, stemmed_tokens
+from splice import Edit, can_wrap
+from paragraphs import html_offset
+from metrics import metrics
+
+"""Короткие замены:
+1) Заменить в подпункте 2.2.1 Договора словосочетание «…банковский счет Клиента, указанный …» на словосочетание «…счет(а) Клиента, указанный(е) …».
+2) Заменить в тексте Договора словосочетание «…денежная наличность…» на словосочетание «…наличные деньги…» в соответствующих падежах.
+3) В пункте 3.2 слова «…» заменить словами «…».
+
+Из абзацев всех "изменений и дополнений" извлекаем тройки (область, старое словосочетание, новое словосочетание).
+Область - это номера пунктов ("2.2.1"), пустая область означает весь текст документа. Старые словосочетания
+всех изменений собираются в один автомат по основам слов (multimatch.py), так что любая падежная форма находится,
+и каждый основной документ просматривается один раз на все словосочетания сразу. Найденное словосочетание
+становится ссылкой на абзац "изменений и дополнений", в котором сказано о замене.
+"""
+
+# capitalized at the beginning of a sentence: "Слова «…» заменить словами «…»"
+KINDS = u"(?:[Сс]ловосочетани|[Сс]лов|[Вв]ыражени|[Фф]раз|[Цц]ифр)[а-яё]*"
+REPLACEMENT = re.compile(u"[Зз]аменить\\s+(?P<scope>[^«»]*?)\\s*{kinds}\\s+«(?P<old>[^«»]*)»\\s+(?:на\\s+)?(?:{kinds}\\s+)?«(?P<new>[^«»]*)»".format(
+    kinds=KINDS))
+# "В пункте 3.2 слова «…» заменить словами «…»": the scope goes first, and it is the text since the previous
+# quote, so only the last mention of the paragraphs in it counts
+SCOPED_REPLACEMENT = re.compile(u"(?P<scope>[^«»]*?)\\s*{kinds}\\s+«(?P<old>[^«»]*)»\\s+[Зз]аменить\\s+(?:на\\s+)?(?:{kinds}\\s+)?«(?P<new>[^«»]*)»".format(
+    kinds=KINDS))
+NUMBER = r"\d{1,2}(?:\.\d{1,2})*(?![\d])"
+# "в подпункте 2.2.1 Договора", "в пунктах 2.1, 3.4 и 5.1": only the numbers after these words,
+# so that the date of the main document is not taken for a number of its paragraph
+SCOPE = re.compile(u"(?:пункт|раздел)[а-яё]*((?:\\s*,?\\s*(?:и\\s+)?{}\\.?)+)".format(NUMBER))
+SCOPE_NUMBER = re.compile(NUMBER)
+# the number at the beginning of a paragraph of the main document: "2.2.1. Банк обязуется..."
+NUMBERED = re.compile(r"\s*(\d{1,2}(?:\.\d{1,2})*)\.?(?:\s|$)")
+# the ellipses and the spaces around the phrases are not a part of them
+PHRASE_STRIP = u" \t\n\r\xa0….,;"
+
+# target - the key of the amendment, anchor - the name of its paragraph to link to
+# scope - the numbers of the paragraphs of the main document, empty for the whole text
+Replacement = namedtuple("Replacement", "target scope old new anchor")
+
+
+def strip_phrase(text):
+    return text.strip(PHRASE_STRIP)
+
+
+def phrase_key(text):
+    return tuple(token[0] for token in stemmed_tokens(text))
+
+
+def in_scope(number, scope):
+    if not scope:
+        return True
+    return number is not None and any(number == elem or number.startswith(elem + ".") for elem in scope)
+
+
+def extract_replacements(amendment, key):
+    """the short replacements in the paragraphs of the amendment"""
+    result = []
+    for paragraph, text in amendment.paragraph_texts():
+        if u"аменить" not in text:
+            continue
+        found = [(match, list(SCOPE.finditer(match["scope"]))) for match in REPLACEMENT.finditer(text)]
+        found.extend((match, list(SCOPE.finditer(match["scope"]))[-1:]) for match in SCOPED_REPLACEMENT.finditer(text))
+        for match, scopes in sorted(found, key=lambda x: x[0].start("old")):
+            old = strip_phrase(match["old"])
+            if old and phrase_key(old):
+                scope = tuple(number for elem in scopes for number in SCOPE_NUMBER.findall(elem[1]))
+                result.append(Replacement(key, scope, old, strip_phrase(match["new"]), paragraph.anchor))
+    return result
+
+
+class ShortReplacements():
+    """The short replacements of all the amendments, with one matcher for all the old phrases"""
+    def __init__(self, index, tasks):
+        """tasks: (amendment key, keys of its sources), as in linker.add_links"""
+        self.replacements = []
+        # the stems of the old phrase -> the numbers of the replacements with this phrase
+        self.groups = {}
+        # source key -> the amendments of which it is a source
+        self.sources = {}
+        for target_key, source_keys in tasks:
+            found = extract_replacements(index[target_key], target_key)
+            if found:
+                self.replacements.extend(found)
+                for key in source_keys:
+                    self.sources.setdefault(key, set()).add(target_key)
+        for n, replacement in enumerate(self.replacements):
+            self.groups.setdefault(phrase_key(replacement.old), []).append(n)
+        metrics.count("short replacements", len(self.replacements))
+        self.matcher = PhraseMatcher((self.replacements[numbers[0]].old, phrase)
+                                     for phrase, numbers in self.groups.items())
+
+    def __len__(self):
+        return len(self.replacements)
+
+    def source_edits(self, source, key):
+        """The links from the old phrases in the source to the amendments, as edits of its html (see splice.py).
+           The paragraphs of the source are looked through once for all the phrases"""
+        targets = self.sources.get(key)
+        if not targets:
+            return []
+        edits = []
+        html_text = None
+        number = None
+        for paragraph, text in source.paragraph_texts():
+            numbered = NUMBERED.match(text)
+            if numbered:
+                number = numbered[1]
+            for start, end, phrase in self.matcher.find_all(text):
+                for n in self.groups[phrase]:
+                    replacement = self.replacements[n]
+                    if replacement.target not in targets or not in_scope(number, replacement.scope):
+                        continue
+                    if html_text is None:
+                        html_text = source.read_html()
+                    html_start, html_end = html_offset(paragraph, start), html_offset(paragraph, end)
+                    if can_wrap(html_text, paragraph, html_start, html_end):
+                        metrics.count("replacement matches")
+                        target_fname = os.path.join(replacement.target[1], replacement.target[0])
+                        href = "../{}#{}".format(target_fname, replacement.anchor or "")
+                        edits.append(Edit(html_start, html_end, href, False))
+                    # the earliest amendment wins
+                    break
+        return edits
@@ -1,24 +1,81 @@
 import argparse
-from indexer import Indexer
-from linker import add_links
+import atexit
+import sys
+import time
+from metrics import metrics
+
+"""Модули этапов (indexer, linker и то, что они тянут за собой) импортируются только тогда, когда этап
+запускается. В режиме наблюдения (-w) процесс не завершается: индекс и пул процессов, разбирающих документы,
+остаются в памяти, каждые несколько секунд проверяются отпечатки файлов в data/, изменившиеся документы
+разбираются заново, и ссылки переставляются только в тех основных документах, которых эти изменения касаются.
+"""
 
 DEFAULT_NUMBER = 140
+STAGES = ("index", "pickle", "unpickle", "links")
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("-n", "--number", help="number of documents to add to index", default=DEFAULT_NUMBER, type=int)
     parser.add_argument("-i", "--index", help="add documents to index", action='store_true')
+    parser.add_argument("-u", "--update", help="update the existing index: parse only new and changed documents", action='store_true')
+    parser.add_argument("-m", "--max-in-memory", help="write the texts of parsed documents to disk by portions of this size", default=None, type=int)
     parser.add_argument("-l", "--links", help="add links", action='store_true')
+    parser.add_argument("-j", "--jobs", help="number of processes for adding links", default=1, type=int)
+    parser.add_argument("-w", "--watch", help="keep running: check data/ every WATCH seconds, update the index and the links of what has changed", default=None, type=float)
+    parser.add_argument("--metrics", help="collect the timers and counters and print them at exit", choices=("summary", "json"))
+    parser.add_argument("--metrics-file", help="file for the metrics (stderr by default)")
+    parser.add_argument("--profile", help="save the cProfile of these stages to profile_<stage>.prof", nargs="+", choices=STAGES, default=())
     args = parser.parse_args()
     return args
 
+def watch(s, args):
+    """the index stays in memory and the workers of the pool stay warm between the checks"""
+    from multiprocessing import Pool, cpu_count
+    from utils import init_stem_worker, warm_up
+    from linker import add_links, link_sources
+    warm_up()
+    # the sources of the amendments as they were linked, to remove the links which are gone with a change
+    if s.exists():
+        s.unpickle()
+    previous = link_sources(s.index, s.title_index)
+    pool = Pool(processes=cpu_count(), initializer=init_stem_worker, initargs=(s.stem_cache_path(), metrics.enabled))
+    try:
+        while True:
+            changed = s.run(incremental=True, max_in_memory=args.max_in_memory, pool=pool)
+            if changed:
+                s.pickle()
+                previous = add_links(s.index, s.title_index, processes=args.jobs, changed=changed, previous=previous)
+            time.sleep(args.watch)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.terminate()
+        pool.join()
+
 if __name__ == "__main__":
     args = parse_args()
 
+    if args.metrics or args.profile:
+        metrics.enable(profile=args.profile)
+        atexit.register(metrics.report, args.metrics or "summary", args.metrics_file)
+
+    from indexer import Indexer
     s = Indexer(args.number)
-    if args.index:
-        s.run(); 
-        s.pickle()
-    if  args.links:
-        s.unpickle()
-        add_links(s.index)
+    if args.watch:
+        watch(s, args)
+    else:
+        if args.index or args.update:
+            with metrics.timer("index"):
+                s.run(incremental=args.update, max_in_memory=args.max_in_memory)
+            with metrics.timer("pickle"):
+                s.pickle()
+        if  args.links:
+            from linker import add_links
+            with metrics.timer("unpickle"):
+                s.unpickle()
+            legacy = s.legacy_docs()
+            if legacy:
+                sys.exit("{} documents were indexed by an old version and have no paragraph table of the current format, "
+                         "update the index first (-u)".format(len(legacy)))
+            with metrics.timer("links"):
+                add_links(s.index, s.title_index, processes=args.jobs)
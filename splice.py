@@ -0,0 +1,119 @@
+import os
+import re
+from bisect import bisect_left
+from collections import namedtuple
+from html import escape
+from documents import FOLDER, DECODE_ERRORS
+from metrics import metrics
+
+"""Вставка ссылок в исходный html без построения дерева. Для документа собираем все правки
+(start, end, href) относительно исходного текста html и применяем их за один проход; все, что не правится,
+переписывается байт в байт.
+Правка бывает двух видов: tag=True - html[start:end] это открывающий тег <a>, у которого мы меняем href;
+tag=False - html[start:end] оборачиваем в <a href=...>...</a>.
+"""
+
+Edit = namedtuple("Edit", "start end href tag")
+
+HREF = re.compile(r"""\shref\s*=\s*("[^"]*"|'[^']*'|[^\s>]+)""", re.IGNORECASE)
+TAG = re.compile(r"<(/?)([a-zA-Z][^\s/>]*)[^>]*?(/?)>")
+VOID_TAGS = {"br", "img", "hr", "meta", "link", "input", "wbr"}
+
+
+def link_paragraph(paragraph, href):
+    """the edits which make a link from the paragraph (an entry of the paragraph table):
+       the existing <a> get the new href, otherwise the content of the paragraph is wrapped"""
+    if paragraph.links:
+        return [Edit(start, end, href, True) for start, end in paragraph.links]
+    return [Edit(paragraph.inner_start, paragraph.inner_end, href, False)]
+
+
+def can_wrap(html_text, paragraph, start, end):
+    """The link can be inserted if the tags inside the found text are balanced
+       and the text is not inside another link already"""
+    opened = []
+    for tag in TAG.finditer(html_text, start, end):
+        closing, name, self_closing = tag[1], tag[2].lower(), tag[3]
+        if name == "a":
+            return False
+        if self_closing or name in VOID_TAGS:
+            continue
+        if closing:
+            if not opened or opened.pop() != name:
+                return False
+        else:
+            opened.append(name)
+    if opened:
+        return False
+    before = html_text[paragraph.inner_start:start].lower()
+    return before.count("<a ") + before.count("<a>") <= before.count("</a>")
+
+
+def set_href(tag, href):
+    attribute = ' href="{}"'.format(escape(href))
+    if HREF.search(tag):
+        return HREF.sub(lambda m: attribute, tag, count=1)
+    closing = "/>" if tag.endswith("/>") else ">"
+    return tag[:-len(closing)] + attribute + closing
+
+
+def select_edits(edits):
+    """The edits in the order of the html, without overlaps: of two overlapping edits the first
+       one in the given list wins, so the result does not depend on the order of the positions"""
+    spans = []
+    chosen = []
+    for edit in edits:
+        span = (edit.start, edit.end)
+        k = bisect_left(spans, span)
+        if k > 0 and spans[k - 1][1] > edit.start:
+            continue
+        if k < len(spans) and (spans[k][0] < edit.end or spans[k] == span):
+            continue
+        spans.insert(k, span)
+        chosen.insert(k, edit)
+    return chosen
+
+
+def apply_edits(html, edits):
+    """one linear pass over the html"""
+    parts = []
+    pos = 0
+    chosen = select_edits(edits)
+    metrics.count("links inserted", len(chosen))
+    for edit in chosen:
+        parts.append(html[pos:edit.start])
+        if edit.tag:
+            parts.append(set_href(html[edit.start:edit.end], edit.href))
+        else:
+            parts.append('<a href="{}">'.format(escape(edit.href)))
+            parts.append(html[edit.start:edit.end])
+            parts.append("</a>")
+        pos = edit.end
+    parts.append(html[pos:])
+    return "".join(parts)
+
+
+def new_html_path(key):
+    html_file, folder = key
+    return os.path.join(FOLDER, folder, html_file).replace(".html", "_new.html")
+
+
+def remove_new_html(key):
+    """the modified copy is removed when the document has no links any more"""
+    new_fname = new_html_path(key)
+    if os.path.exists(new_fname):
+        os.remove(new_fname)
+        print ("removed", new_fname)
+
+
+def write_new_html(doc, edits):
+    """writes the modified copy of the document next to it, once for all the edits"""
+    new_fname = new_html_path((doc.html_file, doc.folder))
+    # the same encoding and newlines as in the original, so that the unmodified parts stay the same bytes
+    with metrics.timer("write_new_html"), \
+            open(new_fname, 'w', encoding=doc.encoding, errors=DECODE_ERRORS if doc.encoding else None,
+                 newline="" if doc.encoding else None) as fh:
+        fh.write(apply_edits(doc.read_html(), edits))
+        print (new_fname)
+    metrics.count("files written")
+    return new_fname
@@ -0,0 +1,75 @@
+import hashlib
+import os
+import pickle
+
+"""Индекс на диске, разбитый на части. В каталоге хранятся:
+meta - небольшая таблица, которая загружается сразу: названия, признаки, main_doc_title, order_titles, пути,
+а также отпечатки файлов и индекс названий;
+shards/ - по файлу на документ с большими полями (текст, таблица абзацев). Они читаются, только когда
+к этим полям обращаются (см. Document.__getattr__), и переписываются, только когда документ изменился.
+"""
+
+META = "meta"
+SHARDS = "shards"
+
+
+def dump(obj, path):
+    """write through a temporary file, so that an interrupted run does not leave a broken file"""
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as fh:
+        pickle.dump(obj, fh, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+
+def load(path):
+    with open(path, "rb") as fh:
+        return pickle.load(fh)
+
+
+class ShardedStore():
+    def __init__(self, path):
+        self.path = path
+
+    def exists(self):
+        return os.path.isfile(os.path.join(self.path, META))
+
+    def shard_path(self, key):
+        html_file, folder = key
+        name = hashlib.md5(os.path.join(folder, html_file).encode("utf-8")).hexdigest()
+        return os.path.join(self.path, SHARDS, name)
+
+    def write_doc(self, key, doc, unload=True):
+        """write the large fields of the document to its shard; if unload, they are dropped from memory
+           and will be loaded lazily"""
+        os.makedirs(os.path.join(self.path, SHARDS), exist_ok=True)
+        shard = self.shard_path(key)
+        dump(doc.heavy_fields(), shard)
+        doc.unload(shard, drop=unload)
+
+    def remove_doc(self, key):
+        shard = self.shard_path(key)
+        if os.path.exists(shard):
+            os.remove(shard)
+
+    def write_meta(self, index, **tables):
+        """index: key -> document; the documents must already have their shards"""
+        os.makedirs(self.path, exist_ok=True)
+        docs = [(key, doc.light_state()) for key, doc in index.items()]
+        dump(dict(tables, docs=docs), os.path.join(self.path, META))
+
+    def keys(self):
+        """the keys of the documents in the saved metadata table"""
+        if not self.exists():
+            return []
+        return [key for key, _ in load(os.path.join(self.path, META))["docs"]]
+
+    def read_meta(self, document_class):
+        """(the index with the lazily loaded documents, the other tables)"""
+        tables = load(os.path.join(self.path, META))
+        index = {}
+        for key, state in tables.pop("docs"):
+            doc = document_class.__new__(document_class)
+            doc.__setstate__(state)
+            doc.unload(self.shard_path(key))
+            index[key] = doc
+        return index, tables
@@ -0,0 +1,27 @@
+from linker import touched_sources, affected_tasks
+
+A, B = ("a.html", "A"), ("b.html", "B")
+S1, S2, S3 = ("s1.html", "S1"), ("s2.html", "S2"), ("s3.html", "S3")
+
+
+def test_changed_amendment_touches_old_and_new_sources():
+    assert touched_sources({A: [S2]}, {A: [S1]}, {A}) == {A, S1, S2}
+
+
+def test_new_source_takes_an_unchanged_amendment():
+    # S2 is added and becomes the source of A instead of S1: S1 loses the links to A
+    touched = touched_sources({A: [S2], B: [S3]}, {A: [S1], B: [S3]}, {S2})
+    assert touched == {S1, S2}
+    assert affected_tasks([(A, [S2]), (B, [S3])], touched) == [(A, [S2])]
+
+
+def test_removed_source_is_replaced():
+    # S1 is removed and S3 becomes the best match for A: A must be linked into S3
+    touched = touched_sources({A: [S3]}, {A: [S1]}, {S1})
+    assert touched == {S1, S3}
+    assert affected_tasks([(A, [S3])], touched) == [(A, [S3])]
+
+
+def test_amendment_loses_its_sources():
+    assert touched_sources({}, {A: [S1]}, {S1}) == {S1}
+    assert touched_sources({B: [S3]}, {B: [S3]}, set()) == set()
@@ -0,0 +1,69 @@
+import pytest
+from paragraphs import extract, paragraph_text, html_offset
+from splice import Edit, link_paragraph, apply_edits
+
+bs4 = pytest.importorskip("bs4")
+
+# the stream text and the paragraph table must be the same as BeautifulSoup gives,
+# the offsets of splice.py rest on it (\r\n is translated by the scanner on purpose, so it is not here)
+CASES = [
+    u"<html><body><p>Простой абзац</p><p>Второй <b>жирный</b> абзац</p></body></html>",
+    u"<p>внешний <p>вложенный</p> хвост</p>",
+    u"<div><p>не закрыт<p>тоже не закрыт</div><p>после</p>",
+    u"<p>до<script>var x = '<p>не абзац</p>';</script>после</p><style>p {color: red}</style>",
+    u"<p>&laquo;кавычки&raquo; &amp; &#171;числом&#187; &#x2014; &nosuchentity; конец</p>",
+    u"<p>текст<![CDATA[ внутри <cdata> ]]>дальше</p>",
+    u"<p>до<!-- комментарий -->после</p>\n\n   \n<p>  \n  </p>",
+    u"<pre>  пробелы   \n  сохраняются </pre><p><a name='z1'></a>1. Пункт <a href='x.html'>ссылка</a></p>",
+    u"<table><tr><td><p>в таблице</p></td><td><p>соседняя ячейка</p></td></tr></table>",
+    u"<p>без закрывающего тега в конце документа",
+]
+
+
+@pytest.mark.parametrize("html", CASES)
+def test_extract_matches_beautifulsoup(html):
+    text, paragraphs = extract(html)
+    soup = bs4.BeautifulSoup(html, "html.parser")
+    assert text == soup.text
+    expected = [p.text for p in soup.find_all("p")]
+    assert [paragraph_text(text, p) for p in paragraphs] == expected
+
+
+@pytest.mark.parametrize("html", CASES)
+def test_link_paragraph_round_trip(html):
+    text, paragraphs = extract(html)
+    edits = [edit for p in paragraphs for edit in link_paragraph(p, "../target.html#z1")]
+    result = apply_edits(html, edits)
+    assert bs4.BeautifulSoup(result, "html.parser").text == text
+    assert apply_edits(html, []) == html
+
+
+@pytest.mark.parametrize("html", CASES)
+def test_html_offset_wraps_the_words(html):
+    text, paragraphs = extract(html)
+    for p in paragraphs:
+        words = paragraph_text(text, p).split()
+        if not words:
+            continue
+        start = paragraph_text(text, p).index(words[-1])
+        end = start + len(words[-1])
+        edit = Edit(html_offset(p, start), html_offset(p, end), "x.html", False)
+        soup = bs4.BeautifulSoup(apply_edits(html, [edit]), "html.parser")
+        assert soup.find("a", href="x.html").text == words[-1]
+
+
+def test_undecodable_byte_is_written_back(tmp_path, monkeypatch):
+    from documents import Document, decode_html
+    from splice import write_new_html
+    raw = u"<html><body><p>Привет</p><p>мир</p></body></html>".encode("cp1251").replace(u"мир".encode("cp1251"), b"\x98")
+    text, encoding = decode_html(raw)
+    assert encoding == "cp1251" and text.encode(encoding, errors="surrogateescape") == raw
+    folder = tmp_path / "data" / "F"
+    folder.mkdir(parents=True)
+    (folder / "1.html").write_bytes(raw)
+    (folder / "Properties.xml").write_text(u"<Properties><Subject>Договор</Subject></Properties>", encoding="utf-8")
+    monkeypatch.chdir(tmp_path)
+    doc = Document(("1.html", "F"))
+    write_new_html(doc, link_paragraph(doc.paragraphs[0], "x.html"))
+    assert (folder / "1_new.html").read_bytes() == raw.replace(u"Привет".encode("cp1251"),
+                                                              u'<a href="x.html">Привет</a>'.encode("cp1251"))
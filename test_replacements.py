@@ -0,0 +1,69 @@
+from collections import namedtuple
+import pytest
+from replacements import extract_replacements, in_scope
+
+Paragraph = namedtuple("Paragraph", "anchor")
+KEY = ("1_2017Н4.html", "A")
+
+
+class Amendment():
+    def __init__(self, *texts):
+        self.texts = texts
+
+    def paragraph_texts(self):
+        for n, text in enumerate(self.texts, 1):
+            yield Paragraph("z{}".format(n)), text
+
+
+def triples(*texts):
+    return [(r.scope, r.old, r.new, r.anchor) for r in extract_replacements(Amendment(*texts), KEY)]
+
+
+@pytest.mark.parametrize("text, expected", [
+    (u"Заменить в подпункте 2.2.1 Договора словосочетание «…банковский счет Клиента, указанный …» "
+     u"на словосочетание «…счет(а) Клиента, указанный(е) …».",
+     [(("2.2.1",), u"банковский счет Клиента, указанный", u"счет(а) Клиента, указанный(е)", "z1")]),
+    (u"Заменить в тексте Договора словосочетание «…денежная наличность…» на словосочетание «…наличные деньги…» "
+     u"в соответствующих падежах.",
+     [((), u"денежная наличность", u"наличные деньги", "z1")]),
+    (u"В пункте 3.2 слова «банковский счет» заменить словами «счет».",
+     [(("3.2",), u"банковский счет", u"счет", "z1")]),
+    (u"Слова «Банк» заменить словами «Кредитная организация» по всему тексту.",
+     [((), u"Банк", u"Кредитная организация", "z1")]),
+    (u"Словосочетание «денежная наличность» заменить словосочетанием «наличные деньги».",
+     [((), u"денежная наличность", u"наличные деньги", "z1")]),
+    (u"Заменить в пунктах 2.1, 3.4 и 5.1 слова «расчетный счет» на слова «счет».",
+     [(("2.1", "3.4", "5.1"), u"расчетный счет", u"счет", "z1")]),
+    # the date of the main document is not a number of its paragraph
+    (u"Заменить в подпункте 2.2.1 Договора от 12.03.2015 № 5 слова «расчетный счет» на слова «счет».",
+     [(("2.2.1",), u"расчетный счет", u"счет", "z1")]),
+    (u"Заменить в Договоре от 12.03.2015 слова «расчетный счет» на слова «счет».",
+     [((), u"расчетный счет", u"счет", "z1")]),
+    # only the last mention of the paragraphs before the scope-first wording counts
+    (u"Пункт 1.1 оставить без изменений. В пункте 4.2 слова «Банк» заменить словами «Кредитор».",
+     [(("4.2",), u"Банк", u"Кредитор", "z1")]),
+    (u"Изложить пункт 2 в следующей редакции: «2. Банк обязуется открыть счет».", []),
+])
+def test_extract_replacements(text, expected):
+    assert triples(text) == expected
+
+
+def test_both_wordings_in_order():
+    found = triples(u"Слова «Банк» заменить словами «Кредитор». Заменить в пункте 5.1 слова «счет» на слова «вклад».",
+                    u"В пункте 6 цифры «10» заменить цифрами «20».")
+    assert found == [((), u"Банк", u"Кредитор", "z1"), (("5.1",), u"счет", u"вклад", "z1"),
+                     (("6",), u"10", u"20", "z2")]
+
+
+@pytest.mark.parametrize("number, scope, expected", [
+    ("2.2.1", (), True),
+    (None, (), True),
+    (None, ("2.2",), False),
+    ("2.2", ("2.2",), True),
+    ("2.2.1", ("2.2",), True),
+    ("2.21", ("2.2",), False),
+    ("3.4", ("2.1", "3.4", "5.1"), True),
+    ("4", ("2.1", "3.4", "5.1"), False),
+])
+def test_in_scope(number, scope, expected):
+    assert in_scope(number, scope) is expected
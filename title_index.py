@@ -0,0 +1,32 @@
+class TitleIndex():
+    """Inverted index over the processed titles: stem -> keys of the documents with this stem in clean_title.
+       Amendments are never the sources of links, so they are not indexed.
+       The sizes of the title sets are precomputed for the scoring in linker.find_sources"""
+    def __init__(self, index=None):
+        self.postings = {}
+        self.title_sizes = {}
+        # the position of the document in the index, to keep the order of the documents with equal scores
+        self.order = {}
+        if index:
+            for key, doc in index.items():
+                self.add(key, doc)
+
+    def __len__(self):
+        return len(self.title_sizes)
+
+    def add(self, key, doc):
+        self.order[key] = len(self.order)
+        if doc.is_amendment or not doc.clean_title:
+            return
+        stems = set(doc.clean_title.split())
+        self.title_sizes[key] = len(stems)
+        for stem in stems:
+            self.postings.setdefault(stem, []).append(key)
+
+    def intersections(self, stems):
+        """key -> the number of the given stems in the title of the document"""
+        counts = {}
+        for stem in set(stems):
+            for key in self.postings.get(stem, ()):
+                counts[key] = counts.get(key, 0) + 1
+        return counts
@@ -1,13 +1,128 @@
+import os
 import re
-from nltk.stem.snowball import RussianStemmer
-from nltk import word_tokenize
-import datetime as dt
+import sys
+import pickle
+from collections import OrderedDict
+import functools
+import time
+from metrics import metrics, init_metrics_worker
 
 PARAGRAPH = "\d\d?\.(\d\d?\.)?(\d\d?\.)?"
+STEM_CACHE_SIZE = 200000
+# the text consisting only of cyrillic words, numbers and whitespace is tokenized by word_tokenize
+# exactly as by str.split, so we don't need to run the tokenizer on it
+PLAIN_TEXT = re.compile(r"[\sа-яА-ЯёЁ\d]*")
+# the text for warm_up, it is not plain, so the tokenizer model is loaded
+WARM_UP_TEXT = u"Приказ Банка от 12.03.2017 г. № 170-И «О порядке»."
+
+
+class StemCache():
+    """A single stemmer per process with a bounded LRU cache token -> stem.
+       The vocabulary of the collection is small and very repetitive, so most tokens are hits"""
+    def __init__(self, maxsize=STEM_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._stemmer = None
+        self.stems = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # in pool workers we remember the stems computed since the last drain, to pass them to the parent
+        self.new = None
+        # the persisted caches already loaded by this process (or by the parent before the fork)
+        self.loaded = set()
+
+    @property
+    def stemmer(self):
+        """nltk is imported on the first miss, not when the module is imported"""
+        if self._stemmer is None:
+            from nltk.stem.snowball import RussianStemmer
+            self._stemmer = RussianStemmer()
+        return self._stemmer
+
+    def stem(self, word):
+        stems = self.stems
+        stemmed = stems.get(word)
+        if stemmed is not None:
+            self.hits += 1
+            stems.move_to_end(word)
+            return stemmed
+        self.misses += 1
+        stemmed = self.stemmer.stem(word)
+        self.add(word, stemmed)
+        if self.new is not None:
+            self.new[word] = stemmed
+        return stemmed
+
+    def add(self, word, stemmed):
+        self.stems[word] = stemmed
+        if len(self.stems) > self.maxsize:
+            self.stems.popitem(last=False)
+
+    def update(self, stems, hits=0, misses=0):
+        for word, stemmed in stems.items():
+            self.add(word, stemmed)
+        self.hits += hits
+        self.misses += misses
+
+    def drain(self):
+        """(stems computed since the previous call, hits, misses); the counters are reset"""
+        result = (self.new or {}, self.hits, self.misses)
+        self.new = {} if self.new is not None else None
+        self.hits = self.misses = 0
+        return result
+
+    def info(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.stems), "maxsize": self.maxsize}
+
+    def save(self, path):
+        with open(path, "wb") as fh:
+            pickle.dump(dict(self.stems), fh)
+
+    def load(self, path):
+        """once per path: the stems in memory are never older than those in the file"""
+        if path not in self.loaded and os.path.exists(path):
+            with open(path, "rb") as fh:
+                self.update(pickle.load(fh))
+            self.loaded.add(path)
+
+
+stem_cache = StemCache()
+
+def stem(word):
+    return stem_cache.stem(word)
+
+def init_stem_worker(path=None, measure=False):
+    """Pool initializer: preload the persisted cache and start collecting new stems for the parent"""
+    init_metrics_worker(measure)
+    warm_up()
+    if path:
+        stem_cache.load(path)
+    stem_cache.new = {}
+
+# nltk.word_tokenize, imported on the first text which is not plain
+nltk_tokenizer = None
+
+def word_tokenize(text):
+    global nltk_tokenizer
+    if nltk_tokenizer is None:
+        from nltk import word_tokenize as nltk_tokenizer
+    return nltk_tokenizer(text)
+
+def warm_up(tokenizer=True):
+    """Import nltk and load the stemmer and the tokenizer model now rather than on the first document.
+       Called by the pool initializers, and by the parent before the pool is started: with fork
+       the workers inherit all of it and start warm. The linking does not tokenize, so its pools
+       load only the stemmer (tokenizer=False)"""
+    stem_cache.stemmer.stem(u"договор")
+    if tokenizer:
+        tokenize(WARM_UP_TEXT)
+
+def tokenize(text):
+    if PLAIN_TEXT.fullmatch(text):
+        return text.split()
+    return word_tokenize(text)
 
 def clean_text(text):
-    stemmer = RussianStemmer()
-    stemmed = [stemmer.stem(word) for word in word_tokenize(text)]
+    stemmed = [stem_cache.stem(word) for word in tokenize(text)]
     clean = [word for word in stemmed if word[0].isalpha() or word[0].isdigit()]
     return " ".join(clean)
 
@@ -17,6 +132,11 @@ def normalize(text):
 def letters_only(text):
     return "".join([elem for elem in text if elem.isalpha()])
 
+def found_in(keys, text):
+    """The subset of keys contained in text. Every distinct key is looked for once; str.find is used
+       on purpose, on letters-only texts it is much faster than any automaton written in python"""
+    return {key for key in set(keys) if len(key) <= len(text) and key in text}
+
 def clean_amendment(text):
     text = normalize(text.strip('•'))
     match_pattern = PARAGRAPH + "(?P<text>.*)"
@@ -29,6 +149,21 @@ def clean_amendment(text):
     return text.rstrip(";")
 
 
+def deep_sizeof(obj):
+    """the size of the object together with the strings, tuples, lists and dicts inside it"""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (tuple, list, set, frozenset)):
+        size += sum(deep_sizeof(elem) for elem in obj)
+    elif isinstance(obj, dict):
+        size += sum(deep_sizeof(k) + deep_sizeof(v) for k, v in obj.items())
+    return size
+
+
+def adaptive_chunksize(num_of_tasks, processes):
+    """about four chunks per process: big enough to keep the overhead low, small enough to balance the load"""
+    return max(1, min(50, num_of_tasks // (processes * 4)))
+
+
 def common_subsequence(X, Y):
     return [x for x,y in zip(X, Y) if x==y]
 
@@ -37,15 +172,15 @@ def word_intersection(X, Y):
 
 
 def timeit(func):
+    """prints the time of the call; with the metrics switched on, the time is also recorded there"""
+    @functools.wraps(func)
     def timed(*args, **kwargs):
-        begin = dt.datetime.now()
-        result = func(*args, *kwargs)
-        end = dt.datetime.now()
-        delta = (end - begin).seconds
-        minutes = delta // 60
+        begin = time.perf_counter()
+        with metrics.timer(func.__name__):
+            result = func(*args, **kwargs)
+        delta = time.perf_counter() - begin
+        minutes = int(delta // 60)
         seconds = delta % 60
-        print ("{m} minutes, {s} seconds in {f}".format(f=func.__name__, m=minutes, s=seconds))
+        print ("{m} minutes, {s:.3f} seconds in {f}".format(f=func.__name__, m=minutes, s=seconds))
         return result
     return timed
-        
-